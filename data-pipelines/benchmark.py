@@ -0,0 +1,374 @@
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from bisect import bisect_right
+from datetime import datetime, timezone
+
+import vaccination_data_pipeline
+from common import SessionPool, SnowflakeClient, s3_client, sort_files, unprocessed_files
+from vaccination_data_pipeline import PlanRow, PlanSession, copy_into_statement, list_files, plan_copy_batches
+
+############################################################################################################
+# Offline benchmarks of the pipeline functions (no AWS / Snowflake needed)
+# LocalS3 stands in for the boto3 S3 client & BenchmarkSession for the Snowpark Session , both can add a fixed
+# latency per call. Listings & JSONL / Parquet payloads are generated , results are written as JSON so two
+# versions can be compared with --compare
+#
+#   python -m benchmark --sizes 10000 100000 --output benchmark_results.json
+#   python -m benchmark --sizes 10000 100000 --compare benchmark_results.json
+############################################################################################################
+
+STAGING = 'stg_vacination'
+S3_PREFIX = f'data-lake/{STAGING}/'
+FIRST_TIMESTAMP = 1711917526756
+FILES_PER_TIMESTAMP = 4
+
+# Key , Size & Directory row of the i-th synthetic file , keys are in (unix_timestamp, file_index) order
+def synthetic_key(position: int, prefix: str = S3_PREFIX) -> str:
+    unix_timestamp = FIRST_TIMESTAMP + (position // FILES_PER_TIMESTAMP) * 1000
+    day = datetime.fromtimestamp(unix_timestamp // 1000, timezone.utc).strftime('%Y_%m_%d')
+    return f"{prefix}{day}_{unix_timestamp}_{position % FILES_PER_TIMESTAMP}.jsonl"
+
+def synthetic_size(position: int) -> int:
+    return 64 * 1024 + (position * 7919) % (4 * 1024 * 1024)
+
+def synthetic_directory_row(position: int) -> PlanRow:
+    key = synthetic_key(position, prefix = f"{STAGING}/")
+    return PlanRow(FILE_NAME=key, LAST_MODIFIED='2024-03-31 20:38:46.756 +0000', SIZE=synthetic_size(position)
+                   , UNIX_TIMESTAMP=FIRST_TIMESTAMP + (position // FILES_PER_TIMESTAMP) * 1000
+                   , FILE_INDEX=position % FILES_PER_TIMESTAMP)
+
+class SyntheticKeys:
+    """
+    Keys of a synthetic listing , generated on access so a 10M object bucket is not kept in memory
+    """
+    def __init__(self, count: int, prefix: str = S3_PREFIX):
+        self.count = count
+        self.prefix = prefix
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, position: int) -> str:
+        return synthetic_key(position, self.prefix)
+
+def synthetic_object(position: int) -> dict:
+    return {'Key': synthetic_key(position), 'Size': synthetic_size(position)}
+
+class SyntheticRows:
+    """
+    Rows of a synthetic listing , row(position) is called on access so a 10M file listing is not kept in memory
+    """
+    def __init__(self, count: int, row):
+        self.count = count
+        self.row = row
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, position: int):
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        return self.row(position)
+
+    def __iter__(self):
+        return map(self.row, range(self.count))
+
+def synthetic_rows(count: int):
+    """
+    Generator of vaccination records in the raw format (integer dates)
+    """
+    countries = ['IND', 'USA', 'AU', 'NZ', 'PHIL', None]
+    for number in range(count):
+        yield {'Customer_Name': f"Customer {number}", 'Customer_Id': str(100000 + number), 'Open_Date': 20101012
+               , 'Last_Consulted_Date': 20120101 + number % 28, 'Vaccination_ID': 'MVD', 'Dr_Name': 'Paul'
+               , 'State': 'SA', 'Country': countries[number % len(countries)], 'DOB': 6031987 + (number % 28) * 1000000
+               , 'Is_Active': 'A'}
+
+def jsonl_payload(count: int) -> bytes:
+    return "\n".join(json.dumps(row) for row in synthetic_rows(count)).encode()
+
+def parquet_payload(count: int, row_group_size: int = 100000) -> bytes:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pylist(list(synthetic_rows(count))), buffer, row_group_size=row_group_size)
+    return buffer.getvalue()
+
+class LocalS3:
+    """
+    A stand-in for the boto3 S3 client (list_objects_v2 paginator , get_object with Range , head_object).
+
+    Attributes:
+        listing (int): Number of synthetic objects listed under S3_PREFIX
+        objects (dict): Key & bytes of the objects which can be read
+        latency (float): Seconds added to every page / GET / HEAD
+    """
+    def __init__(self, listing: int = 0, objects: dict = None, latency: float = 0.0):
+        self.keys = SyntheticKeys(listing)
+        self.objects = objects or {}
+        self.latency = latency
+        self.calls = {'list': 0, 'get': 0, 'head': 0}
+
+    def _wait(self, call: str):
+        self.calls[call] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_paginator(self, operation: str):
+        return self
+
+    def paginate(self, Bucket: str, Prefix: str = '', StartAfter: str = None, PaginationConfig: dict = None
+                 , Delimiter: str = None):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        if not S3_PREFIX.startswith(Prefix) and not Prefix.startswith(S3_PREFIX):
+            return
+        position = bisect_right(self.keys, max(StartAfter or '', Prefix))
+        while position < len(self.keys):
+            self._wait('list')
+            end = min(position + page_size, len(self.keys))
+            contents = [{'Key': self.keys[number], 'Size': synthetic_size(number)} for number in range(position, end)]
+            yield {'Contents': [obj for obj in contents if obj['Key'].startswith(Prefix)], 'KeyCount': end - position}
+            position = end
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None) -> dict:
+        self._wait('get')
+        data = self.objects[Key]
+        if Range:
+            start, end = Range.split('=')[1].split('-')
+            data = data[int(start):int(end) + 1]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        self._wait('head')
+        return {'ContentLength': len(self.objects[Key])}
+
+class BenchmarkFile:
+    """
+    session.file stand-in , PUT only records the file
+    """
+    def __init__(self):
+        self.puts = []
+
+    def put(self, local_file: str, stage_location: str, **kwargs):
+        self.puts.append((local_file, stage_location))
+
+class BenchmarkSession(PlanSession):
+    """
+    A stand-in for Snowpark Session , SQL is recorded (PlanSession) & every statement waits latency seconds.
+
+    Attributes:
+        listing (int): Number of files the Directory table returns (generated on access)
+        countries (list): Countries returned by the country discovery
+        latency (float): Seconds added to every statement
+        watermark (tuple): (UNIX_TIMESTAMP, FILE_INDEX) returned for the S3_FILES query of unprocessed_files
+    """
+    def __init__(self, listing: int = 0, countries: list = None, latency: float = 0.0, watermark: tuple = None):
+        super().__init__(countries = countries)
+        self.files = SyntheticRows(listing, synthetic_directory_row)
+        self.latency = latency
+        self.watermark = watermark
+        self.file = BenchmarkFile()
+
+    def _result(self, query: str) -> list:
+        if 'S3_FILES' in query and 'limit 1' in query:
+            return [PlanRow(UNIX_TIMESTAMP=self.watermark[0], FILE_INDEX=self.watermark[1])] if self.watermark else []
+        if 'Select File_Source, count(*)' in query:
+            # Every listed file is in the Staging table
+            return (PlanRow(FILE_SOURCE=file['FILE_NAME'], ROW_COUNT=1) for file in self.files)
+        return super()._result(query)
+
+    def sql(self, query: str):
+        if self.latency:
+            time.sleep(self.latency)
+        return super().sql(query)
+
+def measure(function, items: int, repeat: int = 1, memory: bool = True) -> dict:
+    """
+    Function to time function() repeat times & run it once more under tracemalloc for the peak memory
+    (tracemalloc only sees Python allocations , Arrow buffers are not counted)
+    Output:
+        dict :- {'items', 'seconds' (median latency of a call), 'latency_p95', 'throughput' (items per second), 'peak_memory_bytes'}
+    """
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    seconds = statistics.median(timings)
+    return {'items': items, 'seconds': round(seconds, 6), 'latency_p95': round(percentile(timings, 95), 6)
+            , 'throughput': round(items / seconds, 2) if seconds else None, 'peak_memory_bytes': peak}
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+def benchmark_client(client, bucket_name: str = 'benchmark-bucket') -> s3_client:
+    s3 = s3_client(bucket_name, None, None)
+    s3.s3_client = client
+    return s3
+
+# Each benchmark gets the size & options , returns (function to measure , items per call)
+def bench_s3_list_files(size: int, options: dict):
+    s3 = benchmark_client(LocalS3(listing = size, latency = options['s3_latency']))
+    return (lambda: s3.list_files(S3_PREFIX)), size
+
+# Listings are generated while they are read (like LocalS3) , so generating the rows is part of the timing
+def bench_sort_files(size: int, options: dict):
+    objects = SyntheticRows(size, synthetic_object)
+    return (lambda: sort_files(objects)), size
+
+def bench_unprocessed_files(size: int, options: dict):
+    s3 = benchmark_client(LocalS3(listing = size, latency = options['s3_latency']))
+    # Half of the files are already processed
+    middle = synthetic_directory_row(size // 2)
+    session = BenchmarkSession(latency = options['sql_latency'], watermark = (middle['UNIX_TIMESTAMP'], middle['FILE_INDEX']))
+    snowflake = SnowflakeClient(None, None, None, None
+                                , pool = SessionPool({}, size = 1, session_factory = lambda parameters: session))
+    return (lambda: unprocessed_files(s3, snowflake, S3_PREFIX, 'BENCHMARK', 'RAW', 'VACCINATION')), size
+
+def bench_list_files(size: int, options: dict):
+    session = BenchmarkSession(listing = size, latency = options['sql_latency'])
+    return (lambda: list_files(session, '@AWS_DEV', '1970-01-01 05:30:00', history_table = 'S3_FILES'
+                               , folder = STAGING)), size
+
+def read_all(body) -> int:
+    from common import iter_jsonl_batches
+
+    return sum(len(lines) for lines in iter_jsonl_batches(body))
+
+def bench_fetch_json(size: int, options: dict):
+    # size is the number of records , payload is split into files of at most 100,000 records
+    keys = {}
+    for number, start in enumerate(range(0, size, 100000)):
+        keys[f"{S3_PREFIX}payload_{number}.jsonl"] = jsonl_payload(min(100000, size - start))
+    s3 = benchmark_client(LocalS3(objects = keys, latency = options['s3_latency']))
+    return (lambda: sum(read_all(s3.fetch_json(key)) for key in keys)), size
+
+def bench_fetch_parquet(size: int, options: dict):
+    import pyarrow.parquet as pq
+
+    key = f"{S3_PREFIX}payload.parquet"
+    s3 = benchmark_client(LocalS3(objects = {key: parquet_payload(size)}, latency = options['s3_latency']))
+    # Only one column is read , the other column chunks are not downloaded
+    return (lambda: pq.read_table(s3.fetch_parquet(key), columns = ['Customer_Id']).num_rows), size
+
+def bench_copy_into_statement(size: int, options: dict):
+    files = SyntheticRows(size, synthetic_directory_row)
+
+    def build():
+        return [copy_into_statement(STAGING, [file['FILE_NAME'][len(STAGING) + 1:] for file in batch], 'STG.', '@AWS_DEV')
+                for batch in plan_copy_batches(files)]
+    return build, size
+
+def bench_main(size: int, options: dict):
+    def run():
+        session = BenchmarkSession(listing = size, countries = ['IND', 'USA', 'AU'], latency = options['sql_latency'])
+        vaccination_data_pipeline.main(session, script = 'dev')
+    return run, size
+
+BENCHMARKS = {'s3_list_files': bench_s3_list_files, 'sort_files': bench_sort_files
+              , 'unprocessed_files': bench_unprocessed_files, 'list_files': bench_list_files
+              , 'fetch_json': bench_fetch_json, 'fetch_parquet': bench_fetch_parquet
+              , 'copy_into_statement': bench_copy_into_statement, 'main': bench_main}
+
+def run_benchmarks(names: list, sizes: list, options: dict) -> list:
+    results = []
+    for name in names:
+        for size in sizes:
+            record = {'benchmark': name, 'size': size}
+            try:
+                function, items = BENCHMARKS[name](size, options)
+                record.update(measure(function, items, repeat = options['repeat'], memory = options['memory']))
+            except ImportError as e:
+                # pyarrow is only needed for the Parquet benchmark
+                record['skipped'] = str(e)
+            print(json.dumps(record))
+            results.append(record)
+    return results
+
+def version() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True
+                              , cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results: list, baseline: dict, threshold: float) -> list:
+    """
+    Function to compare seconds & peak memory with a previous results file
+    Output:
+        list :- (benchmark , size , metric , baseline , current , ratio) where current is worse than threshold
+    """
+    previous = {(record['benchmark'], record['size']): record for record in baseline['results']}
+    regressions = []
+    for record in results:
+        before = previous.get((record['benchmark'], record['size']))
+        if not before or 'skipped' in record or 'skipped' in before:
+            continue
+        for metric in ('seconds', 'peak_memory_bytes'):
+            if before.get(metric) and record.get(metric) is not None:
+                ratio = record[metric] / before[metric]
+                print(f"{record['benchmark']:<20} {record['size']:>10} {metric:<18} {before[metric]:>14} -> {record[metric]:>14} ({ratio:.2f}x)")
+                if ratio > 1 + threshold:
+                    regressions.append((record['benchmark'], record['size'], metric, before[metric], record[metric], ratio))
+    return regressions
+
+def cli(argv: list = None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the data pipeline functions")
+    parser.add_argument('--benchmarks', nargs='*', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--sizes', nargs='*', type=int, default=[10000, 100000]
+                        , help="Objects in the listing / records in the payload (10,000 to 10,000,000)")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per benchmark , median is reported")
+    parser.add_argument('--s3-latency', type=float, default=0.0, help="Seconds added to every S3 page / GET")
+    parser.add_argument('--sql-latency', type=float, default=0.0, help="Seconds added to every SQL statement")
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="Skip the tracemalloc run")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help="Previous results file , exit code is 1 if any benchmark regressed")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Allowed slow down / memory growth , By Default 10%%")
+    args = parser.parse_args(argv)
+
+    options = {'repeat': args.repeat, 's3_latency': args.s3_latency, 'sql_latency': args.sql_latency, 'memory': args.memory}
+    results = run_benchmarks(args.benchmarks, args.sizes, options)
+
+    # Comparison is read before the output is written (same file can be given for both)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+    with open(args.output, 'w') as file:
+        json.dump({'version': version(), 'python': sys.version.split()[0], 'platform': platform.platform()
+                   , 'created_at': datetime.now(timezone.utc).isoformat(), 'options': options, 'results': results}
+                  , file, indent=4)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for benchmark, size, metric, before, after, ratio in regressions:
+            print(f"Regression {benchmark} ({size}) {metric} : {before} -> {after} ({ratio:.2f}x)")
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    cli()
@@ -1,8 +1,18 @@
-
-from snowflake.snowpark import Session
-import boto3
 import io
+import json
+import os
+import queue
 import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from itertools import accumulate
 
 class s3_client:
     """
@@ -19,9 +29,26 @@ class s3_client:
         self.access_key = access_key
         self.secret_key = secret_key
         self.region = region
-        self.s3_client = self._create_s3_client()
+        self._client = None
+
+    # boto3 is imported & client is created only when the first S3 call is made
+    @property
+    def s3_client(self):
+        if self._client is None:
+            self._client = self._create_s3_client()
+        return self._client
+
+    @s3_client.setter
+    def s3_client(self, client):
+        self._client = client
+
+    # boto3 client can not be pickled , a copy sent to another process creates its own client
+    def __getstate__(self):
+        return {**self.__dict__, '_client': None}
 
     def _create_s3_client(self):
+        import boto3
+
         return boto3.client('s3', aws_access_key_id=self.access_key, aws_secret_access_key=self.secret_key,region_name = self.region )
 
     def list_files(self,folder_prefix: str) -> list:   
@@ -30,19 +57,116 @@ class s3_client:
          Attributes:
             folder_prefix (str): 'data-lake/cyara-sit/VoiceTestResult/'
 
+        """
+        return list(self.iter_files(folder_prefix = folder_prefix))
+
+    def iter_files(self, folder_prefix: str, start_after: str = None, page_size: int = 1000):
+        """
+        Generator to List the Files inside the AWS S3 Folder , objects are yielded as soon as each page arrives
+         Attributes:
+            folder_prefix (str): 'data-lake/cyara-sit/VoiceTestResult/'
+            start_after (str) : Key after which listing starts (keys are returned in key order)
+            page_size (int) : Number of keys requested per page , By Default 1000
+
         """
         operation_parameters = {'Bucket': self.bucket_name,
-                        'Prefix': folder_prefix}
-        
+                        'Prefix': folder_prefix,
+                        'PaginationConfig': {'PageSize': page_size}}
+        if start_after:
+            operation_parameters['StartAfter'] = start_after
+
         paginator = self.s3_client.get_paginator('list_objects_v2')
-        page_iterator = paginator.paginate(**operation_parameters)
         #filtered_iterator = page_iterator.search(f"Contents[?contains(Key,`2024_03_`)|| contains(Key, `2024_04_`)]")
         #filtered_iterator = page_iterator.search("Contents[?Size > `500000`]")
-        response =[]
-        for key_data in page_iterator:
-            response.extend(key_data['Contents'])
-        return response
+        for key_data in paginator.paginate(**operation_parameters):
+            # Empty prefix / last page can come without Contents
+            yield from key_data.get('Contents', [])
+
+    def list_sub_prefixes(self, folder_prefix: str, delimiter: str = '/') -> tuple:
+        """
+        Function to List the Sub Folders (CommonPrefixes) & the Files directly inside the AWS S3 Folder
+         Attributes:
+            folder_prefix (str): 'data-lake/cyara-sit/'
+            delimiter (str) : By Default '/'
+         Output:
+            tuple :- (sorted list of sub prefixes , list of files directly under folder_prefix)
+        """
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        sub_prefixes, files = [], []
+        for key_data in paginator.paginate(Bucket=self.bucket_name, Prefix=folder_prefix, Delimiter=delimiter):
+            sub_prefixes.extend(prefix['Prefix'] for prefix in key_data.get('CommonPrefixes', []))
+            files.extend(key_data.get('Contents', []))
+        return sorted(sub_prefixes), files
+
+    def iter_files_parallel(self, folder_prefix: str, sub_prefixes: list = None, max_workers: int = 8
+                            , delimiter: str = '/', pages_in_flight: int = 2, page_size: int = 1000):
+        """
+        Generator to List the Files of the AWS S3 Folder by listing sub prefixes from a thread pool
+        Files are yielded in sub prefix order (then key order) irrespective of which listing finishes first
+        At most max_workers shards are listed at a time & each keeps at most pages_in_flight pages not yet
+        yielded , so memory does not grow with the listing
+         Attributes:
+            folder_prefix (str): 'data-lake/cyara-sit/'
+            sub_prefixes (list) : Shards to list e.g. output of date_prefixes , By Default CommonPrefixes for delimiter
+            max_workers (int) : Number of listing threads , By Default 8
+            delimiter (str) : Used to find the sub prefixes when sub_prefixes is not given , By Default '/'
+            pages_in_flight (int) : Pages a shard lists ahead of the consumer , By Default 2
+            page_size (int) : Number of keys requested per page , By Default 1000
+        """
+        if sub_prefixes is None:
+            sub_prefixes, files = self.list_sub_prefixes(folder_prefix = folder_prefix, delimiter = delimiter)
+            yield from files
+        else:
+            sub_prefixes = sorted(set(sub_prefixes))
+
+        client = self.s3_client
+        stop = threading.Event()
 
+        def put(pages, item) -> bool:
+            # Waits for the consumer but gives up once the generator is closed
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def list_shard(prefix, pages):
+            try:
+                for key_data in client.get_paginator('list_objects_v2').paginate(
+                        Bucket=self.bucket_name, Prefix=prefix, PaginationConfig={'PageSize': page_size}):
+                    if not put(pages, key_data.get('Contents', [])):
+                        return
+            except Exception as e:
+                put(pages, e)
+                return
+            put(pages, None)
+
+        shards = iter(sub_prefixes)
+        window = deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def submit():
+                prefix = next(shards, None)
+                if prefix is not None:
+                    pages = queue.Queue(maxsize=pages_in_flight)
+                    window.append((executor.submit(list_shard, prefix, pages), pages))
+
+            try:
+                for _ in range(max_workers):
+                    submit()
+                # Shards are consumed in order , a new shard starts listing when the oldest one is done
+                while window:
+                    future, pages = window[0]
+                    while (page := pages.get()) is not None:
+                        if isinstance(page, Exception):
+                            raise page
+                        yield from page
+                    window.popleft()
+                    future.result()
+                    submit()
+            finally:
+                stop.set()
 
     def fetch_json(self, file_key:str):
         """
@@ -53,18 +177,330 @@ class s3_client:
         """
         response = self.s3_client.get_object(Bucket=self.bucket_name, Key=file_key)
         return response['Body']
-    
-    def fetch_parquet(self, file_key:str):
+
+    def fetch_json_batches(self, file_key:str, batch_size: int = 10000):
         """
-        Function to read the Parquet files 
+        Generator to read the json lines files in batches of records , only one batch is kept in memory
         Attributes:
             file_key (str): 'data-lake/github_json/issues/2024_03_31_1711917526756_0.jsonl'
-        Example pd.read_parquet(s3.fetch_parquet('data-lake/aha_parquet/goals/2024_02_26_1708906210762_0.parquet'))
+            batch_size (int) : Number of records per batch , By Default 10,000
+        Example for records in s3.fetch_json_batches('data-lake/github_json/issues/2024_03_31_1711917526756_0.jsonl'): pd.DataFrame(records)
         """
-        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=file_key)
-        body_content = response['Body'].read()
-        buffer = io.BytesIO(body_content)
-        return buffer
+        for lines in iter_jsonl_batches(self.fetch_json(file_key), batch_size = batch_size):
+            yield [json.loads(line) for line in lines]
+    
+    def fetch_parquet(self, file_key:str, block_size: int = 1024 * 1024, cache_blocks: int = 8):
+        """
+        Function to read the Parquet files , the file is read lazily with ranged GETs (S3RangeReader)
+        so only the footer & the column chunks / row groups the reader asks for are downloaded
+        Attributes:
+            file_key (str): 'data-lake/aha_parquet/goals/2024_02_26_1708906210762_0.parquet'
+            block_size (int) : Size of the cached blocks , By Default 1 MB
+            cache_blocks (int) : Number of blocks kept in cache (footer & metadata reads) , By Default 8
+        Example pd.read_parquet(s3.fetch_parquet('data-lake/aha_parquet/goals/2024_02_26_1708906210762_0.parquet'), columns=['id'])
+        """
+        return S3RangeReader(self.s3_client, self.bucket_name, file_key, block_size = block_size, cache_blocks = cache_blocks)
+
+class S3RangeReader(io.RawIOBase):
+    """
+    A seekable read only file object over an S3 object which serves reads with ranged GETs.
+
+    Small reads (Parquet footer / page headers) are served from an LRU cache of fixed size blocks ,
+    reads bigger than the cache go directly to S3 without being cached.
+
+    Attributes:
+        client : boto3 S3 client
+        bucket_name (str): The name of the S3 bucket
+        file_key (str): S3 key of the object
+        block_size (int): Size of one cached block in bytes
+        cache_blocks (int): Maximum number of blocks in the cache
+    """
+    def __init__(self, client, bucket_name: str, file_key: str, block_size: int = 1024 * 1024, cache_blocks: int = 8):
+        super().__init__()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.size = client.head_object(Bucket=bucket_name, Key=file_key)['ContentLength']
+        self.position = 0
+        self.bytes_fetched = 0
+        self._cache = OrderedDict()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if self.position < 0:
+            raise ValueError("Negative seek position")
+        return self.position
+
+    def _get_range(self, start: int, end: int) -> bytes:
+        # end is exclusive , HTTP Range is inclusive
+        response = self.client.get_object(Bucket=self.bucket_name, Key=self.file_key, Range=f"bytes={start}-{end - 1}")
+        data = response['Body'].read()
+        self.bytes_fetched += len(data)
+        return data
+
+    def _read_range(self, start: int, end: int) -> bytes:
+        first_block, last_block = start // self.block_size, (end - 1) // self.block_size
+
+        if last_block - first_block + 1 > self.cache_blocks:
+            return self._get_range(start, end)
+
+        missing = [block for block in range(first_block, last_block + 1) if block not in self._cache]
+        if missing:
+            # One GET for all the missing blocks
+            fetch_start = missing[0] * self.block_size
+            data = self._get_range(fetch_start, min((missing[-1] + 1) * self.block_size, self.size))
+            for block in range(missing[0], missing[-1] + 1):
+                offset = block * self.block_size - fetch_start
+                self._cache[block] = data[offset:offset + self.block_size]
+
+        blocks = []
+        for block in range(first_block, last_block + 1):
+            self._cache.move_to_end(block)
+            blocks.append(self._cache[block])
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+
+        offset = start - first_block * self.block_size
+        data = blocks[0] if len(blocks) == 1 else b"".join(blocks)
+        return data[offset:offset + end - start]
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        if self.position >= end:
+            return b""
+        data = self._read_range(self.position, end)
+        self.position = end
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+class BulkWriteError(Exception):
+    """
+    Raised by SnowflakeClient.write_to_snowflake when any chunk could not be written.
+
+    Attributes:
+        result (dict): rows / bytes / chunks uploaded , elapsed & failures (file name --> exception)
+    """
+    def __init__(self, message: str, result: dict):
+        super().__init__(message)
+        self.result = result
+
+def frame_to_parquet(frame, path: str, compression: str = 'snappy') -> tuple:
+    """
+    Function to write a DataFrame / pyarrow Table chunk as Parquet file (runs in the process pool of write_to_snowflake)
+    Output:
+        tuple :- (path , rows , file size in bytes)
+    """
+    if hasattr(frame, 'to_parquet'):
+        frame.to_parquet(path, engine='pyarrow', compression=compression, index=False)
+    else:
+        import pyarrow.parquet as pq
+        pq.write_table(frame, path, compression=compression)
+    return path, len(frame), os.path.getsize(path)
+
+class PooledSession:
+    """
+    A Snowpark Session kept in SessionPool along with the database/schema of its last USE statement.
+
+    Attributes:
+        session : Snowpark Session
+        context (tuple) : (database, schema) the session currently uses , None if unknown
+        last_used (float) : time.monotonic() when the session was released to the pool
+    """
+    def __init__(self, session):
+        self.session = session
+        self.context = None
+        self.last_used = time.monotonic()
+
+    def use(self, database: str, schema: str):
+        """
+        Function to switch database/schema , the USE statement is skipped if session already uses them
+        """
+        if self.context != (database, schema):
+            self.session.sql(f"USE {database}.{schema}").collect()
+            self.context = (database, schema)
+
+class SessionPool:
+    """
+    A class to reuse Snowpark Sessions instead of login for every `with snowflake:` block.
+
+    Attributes:
+        connection_parameters (dict): Passed to Session.builder.configs
+        size (int): Maximum number of open sessions , acquire waits when all are in use
+        idle_timeout (float): Sessions idle for more than idle_timeout seconds are closed
+        health_check_after (float): Sessions idle for more than health_check_after seconds are checked with
+                                    SELECT 1 before reuse & replaced if the check fails
+        session_factory (callable): Creates a session from connection_parameters , By Default Snowpark Session builder
+    """
+    def __init__(self, connection_parameters: dict, size: int = 4, idle_timeout: float = 600
+                 , health_check_after: float = 60, session_factory = None):
+        self.connection_parameters = connection_parameters
+        self.session_factory = session_factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.idle = []
+        self.open_sessions = 0
+        self.condition = threading.Condition()
+
+    def _create(self) -> PooledSession:
+        if self.session_factory is not None:
+            return PooledSession(self.session_factory(self.connection_parameters))
+
+        from snowflake.snowpark import Session
+
+        return PooledSession(Session.builder.configs(self.connection_parameters).create())
+
+    def _healthy(self, pooled: PooledSession) -> bool:
+        try:
+            pooled.session.sql("SELECT 1").collect()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, pooled: PooledSession):
+        try:
+            pooled.session.close()
+        except Exception as e:
+            print(f"Error closing session: {e}")
+
+    def evict_idle(self):
+        """
+        Function to close the sessions idle for more than idle_timeout seconds
+        """
+        now = time.monotonic()
+        with self.condition:
+            expired = [pooled for pooled in self.idle if now - pooled.last_used > self.idle_timeout]
+            self.idle = [pooled for pooled in self.idle if pooled not in expired]
+            self.open_sessions -= len(expired)
+            self.condition.notify_all()
+        for pooled in expired:
+            self._close(pooled)
+
+    def acquire(self, timeout: float = None) -> PooledSession:
+        """
+        Function to get a session from the pool , a new session is created if none is idle & pool is not full
+        """
+        self.evict_idle()
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.idle or self.open_sessions < self.size, timeout=timeout):
+                raise TimeoutError(f"No Snowflake session available in {timeout} seconds")
+            if self.idle:
+                # Most recently used session is the least likely to be expired
+                pooled = self.idle.pop()
+            else:
+                pooled = None
+                self.open_sessions += 1
+
+        if pooled is not None:
+            if time.monotonic() - pooled.last_used <= self.health_check_after or self._healthy(pooled):
+                return pooled
+            self._close(pooled)
+
+        # Login is done outside the lock , the slot is already reserved
+        try:
+            return self._create()
+        except Exception:
+            self.release(None, discard=True)
+            raise
+
+    def release(self, pooled: PooledSession, discard: bool = False):
+        """
+        Function to return the session to the pool , discard closes the session (e.g. after a failed commit)
+        """
+        if pooled is not None and discard:
+            self._close(pooled)
+        with self.condition:
+            if discard:
+                self.open_sessions -= 1
+            else:
+                pooled.last_used = time.monotonic()
+                self.idle.append(pooled)
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.open_sessions -= len(idle)
+        for pooled in idle:
+            self._close(pooled)
+
+class SchemaCache:
+    """
+    A class to cache the Columns & Data Types of Snowflake Tables (output of SnowflakeClient.table_schema).
+
+    Entries expire after ttl seconds or when version changes (e.g. pass the deployed DDL version / hash of
+    table_schema.json) & can be dropped with invalidate after a DDL change.
+
+    Attributes:
+        ttl (float): Seconds for which an entry is valid , By Default 3600
+        path (str): Local JSON file to keep the cache between runs , By Default None (in memory only)
+        version (str): Entries written with another version are ignored
+    """
+    def __init__(self, ttl: float = 3600, path: str = None, version: str = None):
+        self.ttl = ttl
+        self.path = path
+        self.version = version
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+
+    def _key(self, database: str, schema: str, table_name: str) -> str:
+        return f"{database}.{schema}.{table_name}".upper()
+
+    def get(self, database: str, schema: str, table_name: str) -> dict:
+        entry = self.entries.get(self._key(database, schema, table_name))
+        if entry is None or entry['version'] != self.version or time.time() - entry['fetched_at'] > self.ttl:
+            return None
+        return entry['columns']
+
+    def put(self, database: str, schema: str, table_name: str, columns: dict):
+        self.entries[self._key(database, schema, table_name)] = {'columns': columns, 'version': self.version
+                                                                 , 'fetched_at': time.time()}
+        self._save()
+
+    def invalidate(self, database: str = None, schema: str = None, table_name: str = None):
+        """
+        Function to drop the cached tables , None matches everything e.g. invalidate('PRD') drops every table of PRD
+        """
+        parts = [database, schema, table_name]
+        for key in list(self.entries):
+            if all(part is None or part.upper() == key_part for part, key_part in zip(parts, key.split('.', 2))):
+                del self.entries[key]
+        self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(self.entries, file, indent=4)
+        os.replace(temp_path, self.path)
 
 class SnowflakeClient:
     """
@@ -75,36 +511,53 @@ class SnowflakeClient:
         password (str) : Snowflake Password
         account (str) : Snowflake account Number
         warehouse (str) : Virtual Warehouse e.g "TRANSFORM_WH"
+        pool_size (int) : Maximum sessions kept open by the SessionPool , By Default 1
+        idle_timeout (float) : Seconds after which an idle session is closed , By Default 600
+        pool (SessionPool) : Existing SessionPool to share sessions between clients
+        schema_cache (SchemaCache) : Cache of table_schema results , By Default in memory with 1 hour TTL
 
     """
 
-    def __init__(self, user, password, account, warehouse  ):
+    def __init__(self, user, password, account, warehouse , pool_size: int = 1, idle_timeout: float = 600
+                 , pool: SessionPool = None, schema_cache: SchemaCache = None):
         self.user = user
         self.password = password
         self.account = account
         self.warehouse = warehouse
         self.session = None
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.pool = pool
+        self.pooled = None
+        self.schema_cache = schema_cache if schema_cache is not None else SchemaCache()
 
-    def create_session(self):
-        connection_parameters = {
+    def connection_parameters(self) -> dict:
+        return {
             "user": self.user,
             "password": self.password,
             "account": self.account,
             "warehouse": self.warehouse,
         }
-        self.session = Session.builder.configs(connection_parameters).create()
+
+    def create_session(self):
+        from snowflake.snowpark import Session
+
+        self.session = Session.builder.configs(self.connection_parameters()).create()
         return self.session
 
     def __enter__(self):
         """
         This method is called when entering a context manager with the `with` statement.
-        It creates a session and begins a transaction.
+        It takes a session from the pool (login only if no session is idle) and begins a transaction.
         Example
         With Conn:
             conn.execute
         
         """
-        self.create_session()
+        if self.pool is None:
+            self.pool = SessionPool(self.connection_parameters(), size=self.pool_size, idle_timeout=self.idle_timeout)
+        self.pooled = self.pool.acquire()
+        self.session = self.pooled.session
         self.session.sql("begin;").collect()
         return self.session
     
@@ -112,20 +565,33 @@ class SnowflakeClient:
 
         """
         This method is called when exiting a context manager with the `with` statement.
-        It either commits or rolls back a transaction based on the presence of an exception.
+        It either commits or rolls back a transaction based on the presence of an exception
+        & returns the session to the pool. Exceptions are not suppressed.
         """
 
-        if exc_type:
-            self.session.sql("rollback;").collect()
-        else:
-            self.session.sql("commit;").collect()
-            
-        self.session.close()
-        return self
+        pooled, self.pooled, self.session = self.pooled, None, None
+        try:
+            if exc_type:
+                pooled.session.sql("rollback;").collect()
+            else:
+                pooled.session.sql("commit;").collect()
+        except Exception:
+            self.pool.release(pooled, discard=True)
+            raise
+        self.pool.release(pooled)
+        return False
+
+    def close(self):
+        """
+        Function to close all the idle sessions of the pool
+        """
+        if self.pool is not None:
+            self.pool.close()
 
     def execute_query(self, query: str , database: str  , schema: str) -> list:
         """
    Function to Execute Query in Snowflake. (DML - Insert/update/Delete/call Stored Procedure Statement )
+   USE database.schema is only sent if the pooled session is not already using them.
 
     Attributes:
         query (str): The SQL query to be executed, e.g., any DML statement.
@@ -134,33 +600,100 @@ class SnowflakeClient:
     """
         
         try:
-            self.session.sql(f"USE {database}.{schema}").collect()
+            if self.pooled is not None and self.pooled.session is self.session:
+                self.pooled.use(database, schema)
+            else:
+                self.session.sql(f"USE {database}.{schema}").collect()
             
             return self.session.sql(query).collect()
         except Exception as e:
             print(f"Error executing query: {e}")
             raise
            
-    def write_to_snowflake(self, dataframe: str, table: str, database: str, schema: str ,chunk = 100000):
+    def write_to_snowflake(self, dataframe: str, table: str, database: str, schema: str ,chunk = 100000
+                           , compression: str = 'snappy', max_workers: int = None, upload_threads: int = 4
+                           , retries: int = 3, backoff: float = 1.0) -> dict:
         """
    Function to Write DataFrame into Snowflake Tables.
+   Chunks are converted to compressed Parquet files in a process pool , uploaded in parallel to a temporary
+   stage (failed uploads are retried with exponential backoff) & loaded with one COPY INTO.
 
     Attributes:
-        dataframe (str): Pandas Dataframe which we need to insert in Snowflake Table
+        dataframe (str): Pandas Dataframe (or pyarrow Table) which we need to insert in Snowflake Table
         table (str): Snowflake Table where Dataframe will be Written
         database (str) : Snowflake Database name where Table Exists
         schema (str): schema within the specified database
         chunk : By Default 100,000  chunks of rows will be inserted into Snowflake
+        compression (str) : Parquet compression , By Default 'snappy'
+        max_workers (int) : Processes converting chunks to Parquet , By Default number of CPUs
+        upload_threads (int) : Chunks uploaded at the same time , By Default 4
+        retries (int) : Upload attempts per chunk after the first failure , By Default 3
+        backoff (float) : Seconds to wait before 2nd attempt , doubled for every next attempt
+    Output:
+        dict :- {'rows', 'bytes', 'chunks', 'elapsed', 'failures'} , BulkWriteError is raised if any chunk failed
     """
-        try:
-            self.session.write_pandas(dataframe, table_name=table,
-                                    database=database, schema=schema ,chunk_size = chunk , index=False)
-        except Exception as e:
-            print(f"Error writing DataFrame to Snowflake: {e}")
+        start_time = time.perf_counter()
+        result = {'rows': 0, 'bytes': 0, 'chunks': 0, 'elapsed': 0.0, 'failures': {}}
+
+        if len(dataframe) == 0:
+            return result
+
+        stage = f"{database}.{schema}.WRITE_{table}_{uuid.uuid4().hex[:12]}"
+        # pyarrow Tables (output of BatchTransform) are sliced without copying
+        slice_rows = (lambda position: dataframe.iloc[position:position + chunk]) if hasattr(dataframe, 'iloc') \
+            else (lambda position: dataframe.slice(position, chunk))
+        chunks = [slice_rows(position) for position in range(0, len(dataframe), chunk)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, f"{table}_{number}.parquet") for number in range(len(chunks))]
+
+            if len(chunks) == 1 or max_workers == 1:
+                files = [frame_to_parquet(*item, compression) for item in zip(chunks, paths)]
+            else:
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    files = list(executor.map(frame_to_parquet, chunks, paths, [compression] * len(chunks)))
+
+            self.session.sql(f"CREATE TEMPORARY STAGE {stage}").collect()
+
+            def upload(path):
+                for attempt in range(max(retries, 0) + 1):
+                    try:
+                        return self.session.file.put(f"file://{path}", f"@{stage}", auto_compress=False, overwrite=True)
+                    except Exception:
+                        if attempt >= retries:
+                            raise
+                        time.sleep(backoff * 2 ** attempt)
+
+            try:
+                with ThreadPoolExecutor(max_workers=upload_threads) as executor:
+                    futures = {executor.submit(upload, path): (path, rows, size) for path, rows, size in files}
+                    for future, (path, rows, size) in futures.items():
+                        try:
+                            future.result()
+                            result['rows'] += rows
+                            result['bytes'] += size
+                            result['chunks'] += 1
+                        except Exception as e:
+                            result['failures'][os.path.basename(path)] = e
+
+                # Nothing is loaded unless all the chunks are uploaded
+                if not result['failures']:
+                    self.session.sql(f"""COPY INTO {database}.{schema}.{table} FROM @{stage}
+                                        FILE_FORMAT = (TYPE = 'PARQUET')
+                                        MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+                                        ON_ERROR = ABORT_STATEMENT""").collect()
+            finally:
+                self.session.sql(f"DROP STAGE IF EXISTS {stage}").collect()
+
+        result['elapsed'] = time.perf_counter() - start_time
+        if result['failures']:
+            raise BulkWriteError(f"Failed to write {len(result['failures'])} of {len(chunks)} chunks into {table}", result)
+        return result
 
     def table_schema(self,table_list: list, database: str ,schema: str) -> dict:
         """
    Function to Fetch the Snowflake Tables Columns & Data Types.
+   Tables found in schema_cache are not queried again , all the other tables are fetched in one query.
 
     Attributes:
         table_list (list) :- ['employees','timeoff'] List of Input Tables for which we need to fetch the Column name & Data Types
@@ -172,36 +705,56 @@ class SnowflakeClient:
             Useful for creation of Temp Tables        
     """
 
+        result_dict = {}
+        missing_tables = []
+
+        for table_name in table_list:
+            columns = self.schema_cache.get(database, schema, table_name)
+            if columns is None:
+                missing_tables.append(table_name)
+            else:
+                result_dict[table_name] = columns
+
+        if not missing_tables:
+            return result_dict
 
-        query_template = """ SELECT COLUMN_NAME 
+        table_names = ", ".join("'{}'".format(table_name.replace("'", "''")) for table_name in missing_tables)
+        query = f""" SELECT TABLE_NAME , COLUMN_NAME 
                                 , Case when  CHARACTER_MAXIMUM_LENGTH is null then  DATA_TYPE
                                 else CONCAT(DATA_TYPE ,'(', CHARACTER_MAXIMUM_LENGTH  , ')') end as DATA_TYPE 
                             FROM {database}.INFORMATION_SCHEMA.COLUMNS
-                                WHERE TABLE_NAME = '{table_name}' and TABLE_SCHEMA = '{schema}' ; """
-        
-        result_dict = {}
+                                WHERE TABLE_NAME IN ({table_names}) and TABLE_SCHEMA = '{schema}'
+                                ORDER BY TABLE_NAME , ORDINAL_POSITION ; """
 
-        for table_name in table_list:
+        fetched = {}
+        for row in self.execute_query(query = query ,database=database, schema=schema):
+            fetched.setdefault(row.TABLE_NAME, {})[row.COLUMN_NAME] = row.DATA_TYPE
 
-            try:
+        not_found = [table_name for table_name in missing_tables if table_name not in fetched]
+        if not_found:
+            raise ValueError(f"Tables {not_found} not found in {database}.{schema}")
 
-                raw_data = self.execute_query(query = query_template.format( table_name=table_name ,database=database, schema = schema) ,database=database, schema=schema)
-            
-                result_dict[table_name] = {row.COLUMN_NAME: row.DATA_TYPE for row in raw_data}
-            
-            except Exception as e:
-                print(f"Error executing query: {e}")
+        for table_name in missing_tables:
+            self.schema_cache.put(database, schema, table_name, fetched[table_name])
+            result_dict[table_name] = fetched[table_name]
 
         return result_dict
-    def temptable_statement(self,tables: dict) -> list:
+
+    def temptable_statement(self,tables, database: str = None, schema: str = None) -> list:
         """ Function to create Temporary Table Statement/query which will be executed in snowflake for Temporary Table Creation
 
         Attributes:
             table (dict) :- Input the Dictionary which is output of table_schema function
+                            or list of table names , columns are then taken from table_schema (schema_cache)
+            database (str) :- Snowflake database name where tables exists (only for list of table names)
+            schema (str) :- Snowflake schema where tables exists (only for list of table names)
         Output:
             list :- create Temporary Table Statement/query       
     """
 
+        if not isinstance(tables, dict):
+            tables = self.table_schema(tables, database, schema)
+
         create_temp_tables_sql = {}
 
         for table_name, columns_dict in tables.items():
@@ -217,60 +770,280 @@ class SnowflakeClient:
         return create_temp_tables_sql
     
     
-    def merge_statement(self,source_table: str , target_table: str , columns: list , on_columns: list  ) -> str:
+    def merge_statement(self,source_table: str , target_table: str , columns: list , on_columns: list
+                        , database: str = None, schema: str = None
+                        , order_columns: list = ('File_Source', 'FILE_ROW_NUMBER')
+                        , hash_exclude_columns: list = ('Last_Updated_Timestamp', 'File_Source', 'FILE_ROW_NUMBER'
+                                                        , 'ETL_Batch_ID')) -> str:
         """
-        Function to create merge statement to merge Temporary table to Master Table in Snowflake with Condition
+        Function to create upsert (MERGE) statement to merge Temporary table to Master Table in Snowflake
+        1. Source is deduplicated to the latest row per on_columns (ordered by order_columns descending)
+        2. Matched rows are only updated when the row hash of non key columns is different (unchanged rows are not rewritten)
+        3. Not matched rows are inserted
         Attributes:
 
         source_table (str):- Snowflake Source Table name (Temporary Table Name)
         target_table (str) :- Snowflake Target Table Name (Master Table)
         columns (list):- List of columns which we need to Insert (output of table_schema dict values)
-        on_columns (list) :- Primary Key / columns of source & master Table on which Delete  
+                         , None takes the columns of target_table from table_schema (schema_cache)
+                         , a dict of table_schema.json columns also leaves the DEFAULT columns out of the row hash
+        on_columns (list) :- Primary Key / columns of source & master Table on which rows are matched
+        database (str) :- Snowflake database of target_table (only if columns is None)
+        schema (str) :- Snowflake schema of target_table (only if columns is None)
+        order_columns (list) :- Latest row per key is the first by these columns descending (only columns present in columns are used)
+                                File_Source is ordered by the (unix_timestamp, file_index) of the file name & not as text
+                                (Last_Updated_Timestamp is not used as all the rows of one COPY have the same value)
+        hash_exclude_columns (list) :- Load metadata columns which are not compared for change detection
+                                       (load time DEFAULT columns differ on every load & would rewrite every row)
 
 
         """
 
-        update_columns = [f"t.{col} = s.{col}" for col in columns if col not in on_columns]
-        reference_columns = [f"t.{col} = s.{col}" for col in columns if col in on_columns]
+        if columns is None:
+            columns = list(self.table_schema([target_table], database, schema)[target_table])
+
+        excluded = {col.upper() for col in hash_exclude_columns}
+        if isinstance(columns, dict):
+            excluded.update(col.upper() for col, data_type in columns.items() if 'DEFAULT' in str(data_type).upper())
+            columns = list(columns)
+
+        upper_columns = {col.upper(): col for col in columns}
+        key_columns = {col.upper() for col in on_columns}
+
+        value_columns = [col for col in columns if col.upper() not in key_columns]
+        hash_columns = [col for col in value_columns if col.upper() not in excluded]
+        order_by = []
+        for col in order_columns:
+            if col.upper() not in upper_columns:
+                continue
+            col = upper_columns[col.upper()]
+            if col.upper() == 'FILE_SOURCE':
+                # '..._9.jsonl' is after '..._10.jsonl' as text , so the unix_timestamp & file_index are compared as numbers
+                file_key = f"REGEXP_SUBSTR({col}, '\\\\d{{5,}}_\\\\d+')"
+                order_by += [f"TRY_TO_NUMBER(SPLIT_PART({file_key}, '_', {part})) DESC NULLS LAST" for part in (1, 2)]
+            order_by.append(f"{col} DESC NULLS LAST")
+
+        reference_columns = [f"t.{col} = s.{col}" for col in columns if col.upper() in key_columns]
+        update_columns = [f"t.{col} = s.{col}" for col in value_columns]
 
         merge_statement = f"""
                         MERGE INTO {target_table} as t 
-                            USING {source_table} as s
-                                ON {' and '.join(reference_columns)}
-                        WHEN MATCHED THEN 
-                                DELETE ;
-                        Insert INTO {target_table} ({','.join(columns)})
-                        Select {','.join(columns)} from {source_table} 
+                            USING (
+                                Select {','.join(columns)} , HASH({','.join(hash_columns or value_columns or columns)}) as ROW_HASH
+                                from {source_table}
+                                QUALIFY ROW_NUMBER() OVER (PARTITION BY {','.join(on_columns)}
+                                                           ORDER BY {','.join(order_by or on_columns)}) = 1
+                            ) as s
+                                ON {' and '.join(reference_columns)}"""
+
+        if update_columns:
+            merge_statement += f"""
+                        WHEN MATCHED AND HASH({','.join(f't.{col}' for col in (hash_columns or value_columns))}) <> s.ROW_HASH THEN 
+                                UPDATE SET {', '.join(update_columns)}"""
+
+        merge_statement += f"""
+                        WHEN NOT MATCHED THEN 
+                                INSERT ({','.join(columns)})
+                                VALUES ({','.join(f's.{col}' for col in columns)}) ;
                         """
         
         #print(merge_statement)
         
         return merge_statement
     
-def sort_files(files : list)-> list:
-    #unprocessed_files(s3 = s3 , snowflake = conn , s3_path = 'data-lake/cyara-sit/VoiceTestResult/'
-    #                                   , Source = 'CYARA_SIT' , Table = 'VOICETESTRESULT')
+# File names ends with <unix_timestamp>_<file_index>.<extension>
+FILE_KEY_PATTERN = re.compile(r'(\d+_\d+)\.(parquet|jsonl)')
+
+class FileManifest:
     """
-    Sort the Files       
+    A class to keep the listed S3 Files in columnar arrays sorted by (unix_timestamp, file_index).
+
+    Compared to one boto3 dict per file it only keeps the key & three integer arrays , and
+    "files after watermark" / "bytes in range" are answered by bisection.
+
+    Attributes:
+        keys (list): S3 keys
+        timestamps (array): unix timestamp parsed from the key
+        indexes (array): file index parsed from the key
+        sizes (array): Size of the file in bytes
+        unmatched (list): Keys which does not match FILE_KEY_PATTERN (not part of the manifest)
     """
+    def __init__(self, keys: list = None, timestamps: array = None, indexes: array = None, sizes: array = None
+                 , unmatched: list = None):
+        self.keys = keys if keys is not None else []
+        self.timestamps = timestamps if timestamps is not None else array('q')
+        self.indexes = indexes if indexes is not None else array('q')
+        self.sizes = sizes if sizes is not None else array('q')
+        self.unmatched = unmatched if unmatched is not None else []
+        self._cumulative_sizes = None
 
-    pattern = r'(\d+_\d+)\.(parquet|jsonl)'
+    @classmethod
+    def from_objects(cls, objects):
+        """
+        Function to build the manifest from S3 objects (output of s3_client.iter_files / list_files)
+        """
+        keys, timestamps, indexes, sizes, unmatched = [], array('q'), array('q'), array('q'), []
+
+        for obj in objects:
+            key = obj['Key']
+            matched_pattern_data = FILE_KEY_PATTERN.search(key)
+            if matched_pattern_data is None:
+                unmatched.append(key)
+                continue
+            unix_timestamp, index = matched_pattern_data.group(1).split('_')
+            keys.append(key)
+            timestamps.append(int(unix_timestamp))
+            indexes.append(int(index))
+            sizes.append(obj.get('Size') or 0)
+
+        # S3 returns keys in key order which is mostly already the (timestamp, index) order
+        if any((timestamps[i], indexes[i]) > (timestamps[i + 1], indexes[i + 1]) for i in range(len(keys) - 1)):
+            order = sorted(range(len(keys)), key=lambda i: (timestamps[i], indexes[i]))
+            keys = [keys[i] for i in order]
+            timestamps = array('q', (timestamps[i] for i in order))
+            indexes = array('q', (indexes[i] for i in order))
+            sizes = array('q', (sizes[i] for i in order))
 
-    files_to_transform = []
+        return cls(keys, timestamps, indexes, sizes, unmatched)
 
-    for file in files:
+    def __len__(self) -> int:
+        return len(self.keys)
 
-        matched_pattern_data = re.search(pattern, file.get("Key"))
-        match_data = list(matched_pattern_data.groups())[0].split("_")
+    def __getitem__(self, position: int) -> dict:
+        return {'Key': self.keys[position], 'Size': self.sizes[position]
+                , 'unix_timestamp': self.timestamps[position], 'index': self.indexes[position]}
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+    def position(self, watermark: tuple) -> int:
+        """
+        Function to get the position of first file after watermark (unix_timestamp, file_index)
+        """
+        return bisect_right(range(len(self)), tuple(watermark), key=lambda i: (self.timestamps[i], self.indexes[i]))
 
-        file['unix_timestamp'] = int(match_data[0])
-        file['index'] = int(match_data[1])
-                
-        files_to_transform.append(file)
+    def slice(self, start: int = 0, end: int = None) -> 'FileManifest':
+        end = len(self) if end is None else end
+        return FileManifest(self.keys[start:end], self.timestamps[start:end], self.indexes[start:end]
+                            , self.sizes[start:end], self.unmatched)
 
-    return sorted(files_to_transform, key=lambda item: (item['unix_timestamp'], item['index']))
+    def after(self, watermark: tuple) -> 'FileManifest':
+        """
+        Function to get the files after watermark (unix_timestamp, file_index) , None returns all the files
+        """
+        return self if watermark is None else self.slice(self.position(watermark))
+
+    def total_bytes(self, start: int = 0, end: int = None) -> int:
+        """
+        Function to get total size of files between positions start & end
+        """
+        if self._cumulative_sizes is None:
+            self._cumulative_sizes = array('q', accumulate(self.sizes, initial=0))
+        end = len(self) if end is None else end
+        return self._cumulative_sizes[end] - self._cumulative_sizes[start]
+
+class ListingCheckpoint:
+    """
+    A class to persist the S3 listing position locally (JSON file) between pipeline runs.
+
+    For every bucket & prefix it keeps the last key (up to the unix timestamp) which was already processed
+    along with the watermark it was processed under. S3 returns keys in key order so the next listing
+    can start after that key (StartAfter) instead of listing the whole history again.
+
+    Attributes:
+        path (str): Local JSON file e.g. '.listing_checkpoint.json'
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.checkpoints = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as file:
+            return json.load(file)
+
+    def start_after(self, bucket_name: str, folder_prefix: str, watermark: tuple) -> str:
+        """
+        Function to get the key to start the listing after , None means list from the beginning
+        Attributes:
+            watermark (tuple) :- (unix_timestamp, file_index) of last processed file in S3_FILES
+        """
+        checkpoint = self.checkpoints.get(f"{bucket_name}/{folder_prefix}")
+
+        # Checkpoint is only valid if the files before it are still processed (e.g. no reload of older files)
+        if not checkpoint or watermark is None or tuple(checkpoint['watermark']) > tuple(watermark):
+            return None
+        return checkpoint['start_after']
+
+    def update(self, bucket_name: str, folder_prefix: str, start_after: str, watermark: tuple):
+        self.checkpoints[f"{bucket_name}/{folder_prefix}"] = {'start_after': start_after, 'watermark': list(watermark)}
+
+        # Write to a temp file first so a failed run never leaves half written checkpoint
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(self.checkpoints, file, indent=4)
+        os.replace(temp_path, self.path)
+
+def date_prefixes(folder_prefix: str, start_date: date, end_date: date, date_format: str = '%Y_%m_%d_') -> list:
+    """
+    Function to create one S3 prefix per day for folders where file names start with the date
+    e.g. 'data-lake/github_json/issues/2024_03_31_1711917526756_0.jsonl'
+
+    Attributes:
+        folder_prefix (str) :- 'data-lake/github_json/issues/'
+        start_date (date) :- First day (inclusive)
+        end_date (date) :- Last day (inclusive)
+        date_format (str) :- By Default '%Y_%m_%d_'
+    Output:
+        list :- ['data-lake/github_json/issues/2024_03_30_', 'data-lake/github_json/issues/2024_03_31_']
+    """
+    return [folder_prefix + (start_date + timedelta(days=day)).strftime(date_format)
+            for day in range((end_date - start_date).days + 1)]
+
+def watermark_start_after(folder_prefix: str, watermark: tuple, date_format: str = '%Y_%m_%d_') -> str:
+    """
+    Function to create the S3 StartAfter key from the S3_FILES watermark for folders where file names start with
+    the date of the unix timestamp e.g. 'data-lake/github_json/issues/2024_03_31_1711917526756_0.jsonl'
+    Listing starts at the day before the watermark (file names written in another timezone are not missed)
+
+    Attributes:
+        folder_prefix (str) :- 'data-lake/github_json/issues/'
+        watermark (tuple) :- (unix_timestamp, file_index) of last processed file , None lists from the beginning
+        date_format (str) :- By Default '%Y_%m_%d_'
+    Output:
+        str :- 'data-lake/github_json/issues/2024_03_30_' or None
+    """
+    if watermark is None or not date_format:
+        return None
+    day = datetime.fromtimestamp(watermark[0] / 1000, timezone.utc).date() - timedelta(days=1)
+    return folder_prefix + day.strftime(date_format)
+
+# True when the file name after folder_prefix starts with a date in date_format e.g. '2024_03_31_'
+def starts_with_date(key: str, folder_prefix: str, date_format: str = '%Y_%m_%d_') -> bool:
+    width = len(datetime(2000, 1, 1).strftime(date_format))
+    try:
+        datetime.strptime(key[len(folder_prefix):len(folder_prefix) + width], date_format)
+        return True
+    except ValueError:
+        return False
+
+def sort_files(files : list)-> FileManifest:
+    #unprocessed_files(s3 = s3 , snowflake = conn , s3_path = 'data-lake/cyara-sit/VoiceTestResult/'
+    #                                   , Source = 'CYARA_SIT' , Table = 'VOICETESTRESULT')
+    """
+    Sort the Files by (unix_timestamp, file_index) , keys which does not match the pattern are reported & skipped
+    """
+
+    manifest = FileManifest.from_objects(files)
+
+    if manifest.unmatched:
+        print(f"Skipped {len(manifest.unmatched)} files not matching {FILE_KEY_PATTERN.pattern} : {manifest.unmatched[:10]}")
+
+    return manifest
     
-def unprocessed_files(s3,snowflake , s3_path :str  , database :str , schema :str , table :str)-> list:
+def unprocessed_files(s3,snowflake , s3_path :str  , database :str , schema :str , table :str
+                      , checkpoint_path :str = None , key_date_format :str = '%Y_%m_%d_')-> FileManifest:
     #unprocessed_files(s3 = s3 , snowflake = conn , s3_path = 'data-lake/cyara-sit/VoiceTestResult/'
     #                                   , Source = 'CYARA_SIT' , Table = 'VOICETESTRESULT')
     """
@@ -284,9 +1057,14 @@ def unprocessed_files(s3,snowflake , s3_path :str  , database :str , schema :str
         databse :- Snowflake Database where S3_Files Table Exists
         schema :- Snowflake Schema where S3_Files Table Exists
         table :- Snowflake Query Where Condition for table 
+        checkpoint_path (str) :- Local JSON file of ListingCheckpoint , listing starts after the checkpointed key
+                                 so only keys newer than the last run are listed
+        key_date_format (str) :- Date at the start of the file names , listing starts at the day before the
+                                 watermark (watermark_start_after) , None lists the whole s3_path
+                                 , whole s3_path is listed too when its first key does not start with the date
 
     Output :-
-            List of Unprocessed Files
+            FileManifest of Unprocessed Files
         
     """
 
@@ -301,26 +1079,198 @@ def unprocessed_files(s3,snowflake , s3_path :str  , database :str , schema :str
     with snowflake:
         existing_files = snowflake.execute_query(query = query, database = database , schema= schema)
 
-    pattern = r'(\d+_\d+)\.(parquet|jsonl)'
-    
-    files =  s3.list_files(folder_prefix = s3_path)
+    # If CYARA.S3_FILES.FILES Provides empty list then all files need to process
+    watermark = (int(existing_files[0][0]), int(existing_files[0][1])) if existing_files else None
 
-    files_to_transform = []
+    # Keys are listed in key order , so listing starts near the watermark instead of the start of s3_path
+    start_after = watermark_start_after(s3_path, watermark, key_date_format)
+    if start_after:
+        # Keys without the date (e.g. 'raw/v/1712000000001_0.jsonl' , 'raw/v/2024/04/01/...') sort before or
+        # after the StartAfter key whatever their timestamp , one key is listed to check the layout
+        first = next(s3.iter_files(folder_prefix = s3_path, page_size = 1), None)
+        if first is not None and not starts_with_date(first['Key'], s3_path, key_date_format):
+            print(f"Keys under {s3_path} do not start with {key_date_format} (e.g. {first['Key']}) , listing all the keys")
+            start_after = None
 
-    for file in files:
+    # Checkpointed key of the last run is closer to the watermark , whichever starts later is used
+    checkpoint = ListingCheckpoint(checkpoint_path) if checkpoint_path else None
+    checkpoint_start_after = checkpoint.start_after(s3.bucket_name, s3_path, watermark) if checkpoint else None
+    if checkpoint_start_after and checkpoint_start_after > (start_after or ''):
+        start_after = checkpoint_start_after
 
-        matched_pattern_data = re.search(pattern, file.get("Key"))
-        match_data = list(matched_pattern_data.groups())[0].split("_")
+    manifest = sort_files(s3.iter_files(folder_prefix = s3_path, start_after = start_after))
+    files_to_transform = manifest.after(watermark)
 
-        file['unix_timestamp'] = int(match_data[0])
-        file['index'] = int(match_data[1])
+    # Files up to the watermark are already processed , checkpoint the last of them
+    processed = len(manifest) - len(files_to_transform)
+    if checkpoint and processed:
+        last_key = manifest.keys[processed - 1]
+        matched_pattern_data = FILE_KEY_PATTERN.search(last_key)
+        # Key up to the timestamp , so files with the same timestamp & any index are listed again
+        start_after = last_key[:matched_pattern_data.start() + len(str(manifest.timestamps[processed - 1]))]
+        checkpoint.update(s3.bucket_name, s3_path, start_after, watermark)
 
-        if existing_files: # If CYARA.S3_FILES.FILES Provides empty list then all files need to process
+    return files_to_transform
 
-            if file['unix_timestamp'] >= existing_files[0][0] and (file['unix_timestamp'] != existing_files[0][0] or file['index'] > existing_files[0][1]):
-                files_to_transform.append(file)
-                
-        else:
-            files_to_transform.append(file)
+def iter_jsonl_batches(body, batch_size: int = 10000, chunk_size: int = 1024 * 1024):
+    """
+    Generator to split a json lines stream (S3 StreamingBody / file object) into batches of raw lines
+    The body is read chunk_size bytes at a time so memory depends on batch_size & not on the file size
+
+    Attributes:
+        body :- Stream with read(size) e.g. output of s3_client.fetch_json
+        batch_size (int) :- Number of lines per batch , By Default 10,000
+        chunk_size (int) :- Bytes read from the stream at a time , By Default 1 MB
+    Output:
+        list of bytes (one json record per line) , empty lines are skipped
+    """
+    lines, pending = [], b""
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        parts = (pending + chunk).split(b"\n")
+        # Last part can be an incomplete line , keep it for next chunk
+        pending = parts.pop()
+        for line in parts:
+            if line.strip():
+                lines.append(line)
+                if len(lines) >= batch_size:
+                    yield lines
+                    lines = []
+    if pending.strip():
+        lines.append(pending)
+    if lines:
+        yield lines
+
+def jsonl_frame(file_key: str, first_row_number: int, lines: list):
+    """
+    Function to parse a batch of json lines into a Pandas DataFrame with File_Source & FILE_ROW_NUMBER
+    (same metadata which COPY INTO adds with INCLUDE_METADATA)
+    """
+    import pandas as pd
+
+    frame = pd.DataFrame.from_records([json.loads(line) for line in lines])
+    frame['File_Source'] = file_key
+    frame['FILE_ROW_NUMBER'] = range(first_row_number, first_row_number + len(lines))
+    return frame
+
+def jsonl_table(file_key: str, first_row_number: int, lines: list):
+    """
+    Function to parse a batch of json lines into a pyarrow Table with File_Source & FILE_ROW_NUMBER
+    Parsing is done by the multi-threaded Arrow json reader instead of json.loads per line
+    """
+    import pyarrow as pa
+    from pyarrow import json as pa_json
+
+    table = pa_json.read_json(io.BytesIO(b"\n".join(lines)))
+    table = table.append_column('File_Source', pa.repeat(pa.scalar(file_key, pa.string()), table.num_rows))
+    return table.append_column('FILE_ROW_NUMBER', pa.array(range(first_row_number, first_row_number + table.num_rows)
+                                                            , pa.int64()))
+
+async def stream_jsonl_to_snowflake(s3, snowflake, file_keys: list, table: str, database: str, schema: str
+                                    , batch_size: int = 10000, fetch_concurrency: int = 4, parse_workers: int = 2
+                                    , queue_size: int = 4, transform = None, error_table: str = None) -> dict:
+    """
+    Function to load json lines files from S3 into Snowflake with fetch , parse & load running at the same time
+
+    fetch (fetch_concurrency files at a time) --> bounded queue --> parse workers --> bounded queue --> write_to_snowflake
+    When a queue is full the previous stage waits , so at most (2 * queue_size + workers) batches are in memory
+
+    Attributes:
+        s3 :- s3_client
+        snowflake :- SnowflakeClient with an open session (inside `with snowflake:`)
+        file_keys (list) :- S3 keys of json lines files
+        table (str) :- Snowflake Table where batches will be written
+        database (str) :- Snowflake Database name where Table Exists
+        schema (str) :- schema within the specified database
+        batch_size (int) :- Number of records per batch , By Default 10,000
+        fetch_concurrency (int) :- Number of files downloaded at the same time , By Default 4
+        parse_workers (int) :- Number of parse workers , By Default 2
+        queue_size (int) :- Maximum batches waiting between two stages , By Default 4
+        transform :- transform.BatchTransform (or any callable with same output) applied in the parse stage ,
+                     batches are then parsed with jsonl_table (Arrow) instead of jsonl_frame
+        error_table (str) :- Table for the rows failed by transform , required with transform
+                             & created from transform.columns if it does not exist
+    Output:
+        dict :- {'files': files read , 'batches': batches written , 'rows': rows written , 'error_rows': rows
+                 written into error_table}
+    """
+    import asyncio
+
+    if transform is not None and not error_table:
+        raise ValueError("error_table is required with transform")
+
+    if transform is not None and getattr(transform, 'columns', None):
+        from transform import error_table_creation
+
+        await asyncio.to_thread(snowflake.execute_query, error_table_creation(transform.columns, error_table)
+                                , database, schema)
+
+    keys = asyncio.Queue()
+    for file_key in file_keys:
+        keys.put_nowait(file_key)
+    raw_queue = asyncio.Queue(maxsize=queue_size)
+    load_queue = asyncio.Queue(maxsize=queue_size)
+    summary = {'files': 0, 'batches': 0, 'rows': 0, 'error_rows': 0}
+
+    async def fetch():
+        while not keys.empty():
+            file_key = keys.get_nowait()
+            body = await asyncio.to_thread(s3.fetch_json, file_key)
+            batches = iter_jsonl_batches(body, batch_size = batch_size)
+            row_number = 1
+            # Blocking reads of the body are done in a thread , one batch at a time
+            while (lines := await asyncio.to_thread(next, batches, None)) is not None:
+                await raw_queue.put((file_key, row_number, lines))
+                row_number += len(lines)
+            summary['files'] += 1
+
+    async def parse():
+        while (item := await raw_queue.get()) is not None:
+            if transform is None:
+                await load_queue.put((table, await asyncio.to_thread(jsonl_frame, *item)))
+                continue
+            result = await asyncio.to_thread(lambda: transform(jsonl_table(*item)))
+            await load_queue.put((table, result['valid']))
+            if result['error_rows']:
+                await load_queue.put((error_table, result['errors']))
+
+    async def load():
+        while (item := await load_queue.get()) is not None:
+            target, frame = item
+            await asyncio.to_thread(snowflake.write_to_snowflake, frame, target, database, schema)
+            summary['batches'] += 1
+            summary['rows' if target == table else 'error_rows'] += len(frame)
+
+    async def fetch_all():
+        await asyncio.gather(*[fetch() for _ in range(fetch_concurrency)])
+        for _ in range(parse_workers):
+            await raw_queue.put(None)
+
+    async def parse_all():
+        await asyncio.gather(*[parse() for _ in range(parse_workers)])
+        await load_queue.put(None)
+
+    tasks = [asyncio.ensure_future(stage) for stage in (fetch_all(), parse_all(), load())]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # A failed stage would leave the other stages waiting on a full / empty queue
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    return summary
+
+def load_jsonl_files(s3, snowflake, file_keys: list, table: str, database: str, schema: str, **kwargs) -> dict:
+    """
+    Function to run stream_jsonl_to_snowflake from synchronous code , kwargs are passed to stream_jsonl_to_snowflake
+    Example
+    with snowflake:
+        load_jsonl_files(s3, snowflake, [file['Key'] for file in unprocessed], 'VOICETESTRESULT', 'CYARA_SIT', 'RAW')
+    """
+    import asyncio
 
-    return sorted(files_to_transform, key=lambda item: (item['unix_timestamp'], item['index']))
+    return asyncio.run(stream_jsonl_to_snowflake(s3, snowflake, file_keys, table, database, schema, **kwargs))
@@ -0,0 +1,129 @@
+import csv
+import json
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+
+############################################################################################################
+# Step level instrumentation for the Data Pipelines
+# Every step records Wall time , Query IDs , Rows / Bytes loaded & Files , and the queries of the step are
+# tagged with ETL_Batch_ID (QUERY_TAG) so they can be found in QUERY_HISTORY.
+# Records are kept in memory & written at the end of the run with one Insert (or to a local JSON / CSV file)
+############################################################################################################
+
+SUMMARY_COLUMNS = ['ETL_BATCH_ID', 'PIPELINE', 'STEP', 'STATUS', 'STARTED_AT', 'ELAPSED_SECONDS'
+                   , 'ROWS_LOADED', 'BYTES_LOADED', 'FILES', 'QUERY_IDS', 'DETAILS']
+
+class PipelineSummary:
+    """
+    A class to time the steps of a pipeline run & write them to PIPELINE_SUMMARY.
+
+    Attributes:
+        ETL_Batch_ID (int): ETL Run ID
+        pipeline (str): Name of the pipeline e.g. 'vaccination_data_pipeline.dev'
+        session : Snowpark Session , if given the queries of each step are tagged with ETL_Batch_ID & step
+                  and their Query IDs are recorded
+    Example
+        summary = PipelineSummary(ETL_Batch_ID, 'vaccination_data_pipeline.dev', session)
+        with summary.step('list_files') as step:
+            files = list_files(...)
+            step['files'] = len(files)
+        summary.flush(session = session, table = 'PIPELINE_SUMMARY')
+    """
+    def __init__(self, ETL_Batch_ID: int, pipeline: str, session = None):
+        self.ETL_Batch_ID = ETL_Batch_ID
+        self.pipeline = pipeline
+        self.session = session
+        self.steps = []
+
+    @contextmanager
+    def step(self, name: str, session = None, tag: bool = True):
+        """
+        Context manager to time a step , the yielded dict can be updated with
+        rows_loaded , bytes_loaded , files , query_ids (list) & details (dict)
+        session overrides the session of the summary (e.g. session taken from a pool for this step)
+        tag False keeps the QUERY_TAG as it is (no ALTER SESSION e.g. for steps inside a transaction)
+        """
+        session = session if session is not None else self.session
+        record = {'step': name, 'status': 'RUNNING', 'started_at': datetime.now(timezone.utc).isoformat()
+                  , 'elapsed_seconds': 0.0, 'rows_loaded': 0, 'bytes_loaded': 0, 'files': 0
+                  , 'query_ids': [], 'details': {}}
+        self.steps.append(record)
+
+        if session is not None and tag:
+            session.query_tag = json.dumps({'ETL_Batch_ID': self.ETL_Batch_ID, 'pipeline': self.pipeline, 'step': name})
+
+        # Snowpark records the Query ID of every query sent inside query_history (no extra round trip)
+        history = session.query_history() if session is not None else nullcontext()
+
+        start_time = time.perf_counter()
+        try:
+            with history:
+                yield record
+            record['status'] = 'SUCCESS'
+        except Exception as e:
+            record['status'] = 'FAILED'
+            record['details']['error'] = str(e)
+            raise
+        finally:
+            record['elapsed_seconds'] = round(time.perf_counter() - start_time, 3)
+            if session is not None:
+                record['query_ids'].extend(query.query_id for query in history.queries
+                                           if query.query_id not in record['query_ids'])
+
+    def rows(self) -> list:
+        return [[self.ETL_Batch_ID, self.pipeline, record['step'], record['status'], record['started_at']
+                 , record['elapsed_seconds'], record['rows_loaded'], record['bytes_loaded'], record['files']
+                 , json.dumps(record['query_ids']), json.dumps(record['details'], default=str)]
+                for record in self.steps]
+
+    def table_creation(self, table: str) -> str:
+        return f"""CREATE TABLE IF NOT EXISTS {table} (
+                        ETL_BATCH_ID NUMBER(15,0) NOT NULL, PIPELINE TEXT(255), STEP TEXT(100) NOT NULL,
+                        STATUS TEXT(20), STARTED_AT TIMESTAMP_TZ, ELAPSED_SECONDS NUMBER(12,3),
+                        ROWS_LOADED NUMBER(20,0), BYTES_LOADED NUMBER(20,0), FILES NUMBER(10,0),
+                        QUERY_IDS VARIANT, DETAILS VARIANT);"""
+
+    def insert_statement(self, table: str) -> str:
+        """
+        Function to create one Insert statement for all the steps of the run
+        """
+        def value(data):
+            if isinstance(data, (int, float)):
+                return str(data)
+            return "'{}'".format(str(data).replace("\\", "\\\\").replace("'", "''"))
+
+        selects = "\n                UNION ALL ".join(
+            "Select " + ", ".join(f"PARSE_JSON({value(data)})" if column in ('QUERY_IDS', 'DETAILS') else value(data)
+                                  for column, data in zip(SUMMARY_COLUMNS, row))
+            for row in self.rows())
+
+        # VALUES does not allow PARSE_JSON so rows are given as SELECT
+        return f"""Insert into {table} ({', '.join(SUMMARY_COLUMNS)})
+                {selects};"""
+
+    def write_json(self, path: str):
+        with open(path, 'w') as file:
+            json.dump({'ETL_Batch_ID': self.ETL_Batch_ID, 'pipeline': self.pipeline, 'steps': self.steps}
+                      , file, indent=4, default=str)
+
+    def write_csv(self, path: str):
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(SUMMARY_COLUMNS)
+            writer.writerows(self.rows())
+
+    def flush(self, session = None, table: str = None, path: str = None):
+        """
+        Function to write the steps to Snowflake table (one Insert) and/or local file (.json or .csv)
+        """
+        if not self.steps:
+            return
+        if path and path.lower().endswith('.csv'):
+            self.write_csv(path)
+        elif path:
+            self.write_json(path)
+        if session is not None and table:
+            session.query_tag = None
+            session.sql(self.table_creation(table)).collect()
+            session.sql(self.insert_statement(table)).collect()
@@ -0,0 +1,102 @@
+from transform import TYPE_PATTERN, column_rules
+
+############################################################################################################
+# Reconciliation of Staging table & Target / Error tables after the fan out
+# Both sides are aggregated per File_Source & destination (TARGET / ERROR) in Snowflake :-
+#   rows in staging = rows in target tables + rows in error table (for the ETL_Batch_ID)
+#   rows with Null COUNTRY are in error table & all other rows are in target tables
+# Row count & HASH_AGG (order independent checksum) are compared , so only one row per file comes back
+# & target tables are read only for the ETL_Batch_ID (pruned) , cost does not grow with table size
+############################################################################################################
+
+# Function to give the columns compared by the checksum , cast to the table_schema.json type so
+# Staging & Target values hash the same (ETL_Batch_ID is set by the fan out & DEFAULT columns are not loaded)
+def checksum_columns(columns: dict) -> list:
+    return [f"{column}::{TYPE_PATTERN.match(definition).group(0).strip()}"
+            for (column, definition), rule in zip(columns.items(), column_rules(columns).values())
+            if column.upper() != 'ETL_BATCH_ID' and not rule['default']]
+
+def reconciliation_statement(columns: dict, staging_table: str, target_tables: list, error_table: str
+                             , ETL_Batch_ID: int) -> str:
+    """
+    Function to create one query which compares Staging & Target side per File_Source
+
+    Attributes:
+        columns (dict) :- Columns of the table from table_schema.json
+        staging_table (str) :- e.g. 'STG.TEMP_stg_vacination'
+        target_tables (list) :- Base target table & Country tables e.g. ['PRD.vaccination_data', 'PRD.vaccination_data_IND']
+        error_table (str) :- Table for rows with Null COUNTRY , None when the table has no COUNTRY column
+        ETL_Batch_ID (int) :- ETL Run ID of the fan out
+    Output:
+        str :- query returning only the mismatched (FILE_SOURCE , DESTINATION) with counts & checksums of both sides
+    """
+    checksum = ", ".join(checksum_columns(columns))
+    column_list = ", ".join(column.split('::')[0] for column in checksum_columns(columns))
+    destination = "CASE WHEN COUNTRY IS NULL THEN 'ERROR' ELSE 'TARGET' END" if error_table else "'TARGET'"
+
+    loaded = [f"Select 'TARGET' as DESTINATION, {column_list} from {table} where ETL_Batch_ID = {ETL_Batch_ID}"
+              for table in target_tables]
+    if error_table:
+        loaded.append(f"Select 'ERROR' as DESTINATION, {column_list} from {error_table} where ETL_Batch_ID = {ETL_Batch_ID}")
+    loaded = "\n                        UNION ALL ".join(loaded)
+
+    return f"""WITH STAGED as (
+                    Select File_Source, {destination} as DESTINATION, count(*) as ROW_COUNT, HASH_AGG({checksum}) as CHECKSUM
+                    from {staging_table}
+                    group by 1, 2),
+                LOADED as (
+                    Select File_Source, DESTINATION, count(*) as ROW_COUNT, HASH_AGG({checksum}) as CHECKSUM
+                    from ({loaded})
+                    group by 1, 2)
+                Select coalesce(s.File_Source, l.File_Source) as FILE_SOURCE, coalesce(s.DESTINATION, l.DESTINATION) as DESTINATION
+                    , s.ROW_COUNT as STAGED_ROWS, l.ROW_COUNT as LOADED_ROWS, s.CHECKSUM as STAGED_CHECKSUM, l.CHECKSUM as LOADED_CHECKSUM
+                from STAGED s
+                full outer join LOADED l on s.File_Source = l.File_Source and s.DESTINATION = l.DESTINATION
+                where s.ROW_COUNT is distinct from l.ROW_COUNT or s.CHECKSUM is distinct from l.CHECKSUM;"""
+
+def mismatched_files(rows: list) -> dict:
+    """
+    Function to group the output of reconciliation_statement by file
+    Output:
+        dict :- FILE_SOURCE --> list of {'destination', 'staged_rows', 'loaded_rows', 'staged_checksum', 'loaded_checksum'}
+    """
+    mismatches = {}
+    for row in rows or []:
+        row = {key.upper(): value for key, value in (row.as_dict() if hasattr(row, 'as_dict') else dict(row)).items()}
+        mismatches.setdefault(row['FILE_SOURCE'], []).append({'destination': row['DESTINATION']
+                                                              , 'staged_rows': row['STAGED_ROWS'] or 0
+                                                              , 'loaded_rows': row['LOADED_ROWS'] or 0
+                                                              , 'staged_checksum': row['STAGED_CHECKSUM']
+                                                              , 'loaded_checksum': row['LOADED_CHECKSUM']})
+    return mismatches
+
+# Function to count the Staging rows per file , a listed file without rows was skipped by the COPY
+# (e.g. COPY load metadata says it is already loaded) & is not in the full outer join of reconciliation_statement
+def staged_files_statement(staging_table: str) -> str:
+    return f"Select File_Source, count(*) as ROW_COUNT from {staging_table} group by 1;"
+
+def unstaged_files(files: list, rows: list) -> dict:
+    """
+    Function to find the loaded files which have no row in Staging table
+    Files with SIZE 0 have nothing to load & are not reported
+
+    Attributes:
+        files (list) :- Files loaded by the COPY (FILE_NAME, SIZE)
+        rows (list) :- Output of staged_files_statement
+    Output:
+        dict :- FILE_NAME --> list of {'destination': 'STAGING', ...} in the format of mismatched_files
+    """
+    staged = {(row.as_dict() if hasattr(row, 'as_dict') else dict(row)).get('FILE_SOURCE') for row in rows or []}
+    return {file['FILE_NAME']: [{'destination': 'STAGING', 'staged_rows': 0, 'loaded_rows': 0
+                                 , 'staged_checksum': None, 'loaded_checksum': None}]
+            for file in files if file['FILE_NAME'] not in staged and (file.get('SIZE') or 0) > 0}
+
+# Function to remove the rows of mismatched files of this ETL run , so the files can be loaded again
+# (one statement per table & batch_size files so the IN list stays small when a whole run is cleared)
+# column is the file name column of the tables , FILE_NAME for File Ledger
+def delete_files_statements(tables: list, ETL_Batch_ID: int, files: list, batch_size: int = 1000
+                            , column: str = 'File_Source') -> list:
+    file_lists = [", ".join("'{}'".format(str(file).replace("'", "''")) for file in files[start:start + batch_size])
+                  for start in range(0, len(files), batch_size)]
+    return [f"Delete from {table} where ETL_Batch_ID = {ETL_Batch_ID} and {column} in ({file_list});"
+            for table in tables for file_list in file_lists]
@@ -0,0 +1,271 @@
+import argparse
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from common import SessionPool
+from pipeline_summary import PipelineSummary
+from vaccination_data_pipeline import (WAREHOUSE_THREADS, PlanSession, copy_step, create_session, fan_out_step
+                                       , get_connection_parameters, list_step, load_json_file, refresh_step
+                                       , table_names)
+
+############################################################################################################
+# Runs every table of table_schema.json for every environment of pipeline_parameters.json as a DAG
+#
+#   <env>.refresh --> <env>.<table>.list --> <env>.<table>.copy --> <env>.<table>.fan_out
+#
+# Tasks of an environment run with a concurrency budget based on its warehouse size , a failed task is retried
+# & if it still fails only the tasks depending on it are skipped (other tables keep loading)
+# Environments sharing a Staging / Target / Error table or a File Ledger table run one after another
+# (copy_step truncates the Staging table) & every environment gets its own ETL_Batch_ID
+############################################################################################################
+
+# Tables loaded at the same time per warehouse , each table needs about 8 load threads (XS = 1 ... 2XL = 32)
+def warehouse_concurrency(script_parameters: dict) -> int:
+    if script_parameters.get('max_concurrent_tables'):
+        return script_parameters['max_concurrent_tables']
+    return max(1, WAREHOUSE_THREADS[script_parameters.get('warehouse_size', 'XS').upper()] // 8)
+
+# Tables written by an environment , Country tables are named after the target table so it stands for them
+def environment_tables(script_parameters: dict, tables: list) -> set:
+    written = set()
+    for table in tables:
+        names = table_names(script_parameters, table)
+        written.add(f"{script_parameters['temp_schema']}TEMP_{names['staging']}".upper())
+        written.add(f"{script_parameters['target_database']}{names['target']}".upper())
+        written.add(f"{script_parameters['target_database']}{names['error']}".upper())
+        # File Ledger rows are kept per Staging table
+        written.add(f"{script_parameters['history_table']}.{names['staging']}".upper())
+    return written
+
+class Task:
+    """
+    A node of the scheduler DAG.
+
+    Attributes:
+        name (str): e.g. 'prod.VACCINATION_TABLE.copy'
+        env (str): Environment the task belongs to (concurrency budget)
+        function (callable): Called with a Snowpark Session , return value is kept in result
+        dependencies (list): Names of the tasks which must succeed first
+        retries (int): Attempts after the first failure
+        after (list): Names of the tasks which must finish first , whatever their status
+    """
+    def __init__(self, name: str, env: str, function, dependencies: list = None, retries: int = 0, after: list = None):
+        self.name = name
+        self.env = env
+        self.function = function
+        self.dependencies = dependencies or []
+        self.after = after or []
+        self.retries = retries
+        self.status = 'PENDING'
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self.elapsed = 0.0
+
+class PipelineScheduler:
+    """
+    A class to load all the tables of all environments concurrently.
+
+    Attributes:
+        pool (SessionPool): Every task takes a session from the pool , size should be >= sum of budgets
+        environments (dict): Environment name & its parameters (pipeline_parameters.json)
+        table_config (dict): table_schema.json per environment , key as environment
+        ETL_Batch_ID (int): ETL Run ID of the first environment , next environments get ETL_Batch_ID + 1 , + 2 ...
+        backoff (float): Seconds to wait before a retry , doubled for every next attempt
+    """
+    def __init__(self, pool: SessionPool, environments: dict, table_config: dict, ETL_Batch_ID: int
+                 , backoff: float = 5):
+        self.pool = pool
+        self.environments = environments
+        self.table_config = table_config
+        self.ETL_Batch_ID = ETL_Batch_ID
+        self.batch_ids = {env: ETL_Batch_ID + position for position, env in enumerate(environments)}
+        self.backoff = backoff
+        self.summaries = {}
+        self.tasks = {}
+        self.build()
+
+    def add(self, task: Task):
+        self.tasks[task.name] = task
+
+    def build(self):
+        written = {}
+        for env, script_parameters in self.environments.items():
+            retries = script_parameters.get('retries', 0)
+            ETL_Batch_ID = self.batch_ids[env]
+            written[env] = environment_tables(script_parameters, list(self.table_config[env]))
+            # An environment starts after every earlier environment writing one of its tables has finished
+            after = [name for name, task in self.tasks.items() if written[task.env] & written[env]]
+            refresh = f"{env}.refresh"
+            summary = self.summaries[refresh] = PipelineSummary(ETL_Batch_ID, f"scheduler.{env}")
+            self.add(Task(refresh, env, lambda session, p=script_parameters, s=summary: refresh_step(session, s, p)
+                          , retries = retries, after = after))
+
+            for table, columns in self.table_config[env].items():
+                names = table_names(script_parameters, table)
+                summary = self.summaries[f"{env}.{table}"] = PipelineSummary(ETL_Batch_ID, f"scheduler.{env}.{table}")
+                prefix = f"{env}.{table}"
+
+                def list_files(session, p=script_parameters, s=summary, n=names):
+                    return list_step(session, s, p, n['staging'])
+
+                def copy(session, p=script_parameters, s=summary, n=names, c=columns, prefix=prefix, retries=retries
+                         , ETL_Batch_ID=ETL_Batch_ID):
+                    files_to_load = self.tasks[f"{prefix}.list"].result
+                    if not files_to_load:
+                        return None
+                    load_summary = copy_step(session, s, p, ETL_Batch_ID, files_to_load, n['staging'], c)
+                    # Failed batches are retried with the task , after the last attempt the loaded batches
+                    # still fan out & the failures are reported by cli
+                    if load_summary['failures'] and self.tasks[f"{prefix}.copy"].attempts <= retries:
+                        raise RuntimeError(f"COPY failed for batches {sorted(load_summary['failures'])} : {load_summary['failures']}")
+                    return load_summary
+
+                def fan_out(session, p=script_parameters, s=summary, n=names, c=columns, prefix=prefix
+                            , ETL_Batch_ID=ETL_Batch_ID):
+                    load_summary = self.tasks[f"{prefix}.copy"].result
+                    if not load_summary or not load_summary['loaded_files']:
+                        return None
+                    # A retry first removes the rows of an attempt which may have been committed before it failed
+                    return fan_out_step(session, s, p, ETL_Batch_ID, c, n, load_summary['loaded_files']
+                                        , replace = self.tasks[f"{prefix}.fan_out"].attempts > 1)
+
+                self.add(Task(f"{prefix}.list", env, list_files, [refresh], retries))
+                self.add(Task(f"{prefix}.copy", env, copy, [f"{prefix}.list"], retries))
+                self.add(Task(f"{prefix}.fan_out", env, fan_out, [f"{prefix}.copy"], retries))
+
+    def execute(self, task: Task):
+        start_time = time.perf_counter()
+        for attempt in range(task.retries + 1):
+            task.attempts = attempt + 1
+            pooled = self.pool.acquire()
+            try:
+                task.result = task.function(pooled.session)
+                self.pool.release(pooled)
+                break
+            except Exception as e:
+                # A session which failed in the middle of the task is not reused
+                self.pool.release(pooled, discard=True)
+                task.error = e
+                if attempt == task.retries:
+                    raise
+                print(f"Task {task.name} failed (attempt {attempt + 1}) : {e}")
+                time.sleep(self.backoff * 2 ** attempt)
+        task.error = None
+        task.elapsed = time.perf_counter() - start_time
+
+    def run(self) -> dict:
+        """
+        Function to run the DAG
+        Output:
+            dict :- task name & status (SUCCESS / FAILED / SKIPPED) , errors are kept in Task.error
+        """
+        budgets = {env: warehouse_concurrency(parameters) for env, parameters in self.environments.items()}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=sum(budgets.values())) as executor:
+            while True:
+                for task in self.tasks.values():
+                    if task.status != 'PENDING':
+                        continue
+                    dependencies = [self.tasks[name].status for name in task.dependencies]
+                    finished = all(self.tasks[name].status in ('SUCCESS', 'FAILED', 'SKIPPED') for name in task.after)
+                    if any(status in ('FAILED', 'SKIPPED') for status in dependencies):
+                        task.status = 'SKIPPED'
+                    elif finished and all(status == 'SUCCESS' for status in dependencies) and \
+                            sum(1 for running_task in running.values() if running_task.env == task.env) < budgets[task.env]:
+                        task.status = 'RUNNING'
+                        running[executor.submit(self.execute, task)] = task
+
+                if not running:
+                    # Skipping a task can make its dependents skippable , loop until nothing changes
+                    if any(task.status == 'PENDING' for task in self.tasks.values()):
+                        continue
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        future.result()
+                        task.status = 'SUCCESS'
+                    except Exception as e:
+                        task.status = 'FAILED'
+                        print(f"Task {task.name} failed : {e}")
+
+        return {name: task.status for name, task in self.tasks.items()}
+
+    def flush(self):
+        """
+        Function to write the PipelineSummary of every environment & table
+        """
+        pooled = self.pool.acquire()
+        try:
+            for name, summary in self.summaries.items():
+                parameters = self.environments[name.split('.')[0]]
+                path = parameters.get('summary_path')
+                summary.flush(session = pooled.session, table = parameters.get('pipeline_summary')
+                              , path = f"{os.path.splitext(path)[0]}.{name}{os.path.splitext(path)[1]}" if path else None)
+        finally:
+            self.pool.release(pooled)
+
+def cli(argv: list = None):
+    """
+    Command line entry point
+    Example
+        python -m scheduler                 (all environments)
+        python -m scheduler --env prod --plan --files stg_vacination/2024_03_31_1711917526756_0.jsonl --countries IND
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    all_parameters = load_json_file(os.path.join(script_dir, 'pipeline_parameters.json'))
+
+    parser = argparse.ArgumentParser(description="Load every table of every environment as a DAG")
+    parser.add_argument('--env', nargs='*', choices=list(all_parameters), default=list(all_parameters))
+    parser.add_argument('--plan', '--dry-run', dest='plan', action='store_true'
+                        , help="Print the statements of the run without connecting to Snowflake")
+    parser.add_argument('--files', nargs='*', default=[], help="(--plan) File names the stage listing returns")
+    parser.add_argument('--countries', nargs='*', default=[], help="(--plan) Countries found in Staging tables")
+    args = parser.parse_args(argv)
+
+    environments = {env: all_parameters[env] for env in args.env}
+    table_config = {env: load_json_file(os.path.join(script_dir, parameters['table_schema']))
+                    for env, parameters in environments.items()}
+    pool_size = sum(warehouse_concurrency(parameters) for parameters in environments.values())
+
+    if args.plan:
+        # One session so statements are printed in the order they would run
+        plan_session = PlanSession(files = args.files, countries = args.countries)
+        pool = SessionPool({}, size = 1, session_factory = lambda parameters: plan_session)
+        for parameters in environments.values():
+            parameters['max_concurrent_tables'] = 1
+    else:
+        pool = SessionPool(get_connection_parameters(), size = pool_size, session_factory = create_session)
+
+    scheduler = PipelineScheduler(pool, environments, table_config, int(time.time()))
+    try:
+        statuses = scheduler.run()
+        scheduler.flush()
+    finally:
+        pool.close()
+
+    if args.plan:
+        print(";\n\n".join(statement.strip().rstrip(';') for statement in plan_session.statements) + ";")
+    for name, status in statuses.items():
+        print(f"{name} : {status}")
+
+    copy_failures = {name: task.result['failures'] for name, task in scheduler.tasks.items()
+                     if name.endswith('.copy') and task.result and task.result['failures']}
+    for name, failures in copy_failures.items():
+        print(f"{name} : COPY failed for batches {sorted(failures)} : {failures}")
+
+    mismatched = {name: task.result['mismatched_files'] for name, task in scheduler.tasks.items()
+                  if name.endswith('.fan_out') and task.result and task.result.get('mismatched_files')}
+    for name, files in mismatched.items():
+        print(f"{name} : reconciliation failed for {sorted(files)}")
+
+    if copy_failures or mismatched or any(status != 'SUCCESS' for status in statuses.values()):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    cli()
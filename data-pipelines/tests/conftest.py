@@ -0,0 +1,23 @@
+import os
+import sys
+
+# Pipeline modules are imported by name (python -m vaccination_data_pipeline runs from data-pipelines/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vaccination_data_pipeline import PlanSession
+
+class FailingSession(PlanSession):
+    """
+    PlanSession where statements containing a key of fail_on raise , each key fails value times
+    """
+    def __init__(self, fail_on: dict, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_on = dict(fail_on)
+
+    def sql(self, query):
+        for text, times in self.fail_on.items():
+            if text in query and times:
+                self.fail_on[text] = times - 1
+                self.statements.append(query)
+                raise RuntimeError(f"failed : {text}")
+        return super().sql(query)
@@ -0,0 +1,35 @@
+import tracemalloc
+
+import pytest
+
+from benchmark import (BenchmarkSession, SyntheticRows, bench_copy_into_statement, bench_sort_files
+                       , synthetic_directory_row)
+from vaccination_data_pipeline import list_files
+
+OPTIONS = {'s3_latency': 0.0, 'sql_latency': 0.0}
+
+def test_synthetic_listings_are_not_built_up_front():
+    tracemalloc.start()
+    try:
+        session = BenchmarkSession(listing = 10000000)
+        bench_sort_files(10000000, OPTIONS)
+        bench_copy_into_statement(10000000, OPTIONS)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert peak < 1024 * 1024
+    assert len(session.files) == 10000000
+    assert session.files[9999999] == synthetic_directory_row(9999999)
+
+def test_synthetic_rows_iterate_in_position_order():
+    rows = SyntheticRows(3, synthetic_directory_row)
+
+    assert list(rows) == [synthetic_directory_row(position) for position in range(3)]
+    with pytest.raises(IndexError):
+        rows[3]
+
+def test_benchmark_session_lists_its_files():
+    files = list_files(BenchmarkSession(listing = 5), '@AWS_DEV', '1970-01-01 05:30:00', history_table = 'S3_FILES')
+
+    assert [file['FILE_NAME'] for file in files] == [synthetic_directory_row(position)['FILE_NAME'] for position in range(5)]
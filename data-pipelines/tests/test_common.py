@@ -0,0 +1,335 @@
+import io
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+from conftest import FailingSession
+
+from benchmark import S3_PREFIX, BenchmarkSession, LocalS3, synthetic_rows, jsonl_payload, parquet_payload, synthetic_key
+from common import (BulkWriteError, FileManifest, S3RangeReader, SchemaCache, SessionPool, SnowflakeClient, date_prefixes
+                    , iter_jsonl_batches
+                    , load_jsonl_files, s3_client, sort_files, unprocessed_files, watermark_start_after)
+
+def client(local: LocalS3) -> s3_client:
+    s3 = s3_client('benchmark', None, None)
+    s3.s3_client = local
+    return s3
+
+def snowflake_client(session) -> SnowflakeClient:
+    return SnowflakeClient(None, None, None, None, pool = SessionPool({}, size = 1, session_factory = lambda parameters: session))
+
+def test_watermark_start_after_lists_from_the_day_before():
+    watermark = (1711917526756, 0)
+
+    start_after = watermark_start_after(S3_PREFIX, watermark)
+
+    assert start_after == f"{S3_PREFIX}2024_03_30_"
+    assert start_after < synthetic_key(0)
+    assert watermark_start_after(S3_PREFIX, None) is None
+
+def test_unprocessed_files_starts_after_the_watermark_day():
+    local = LocalS3(listing = 5000)
+    watermark = (1711917526756 + 1000, 3)
+
+    files = unprocessed_files(client(local), snowflake_client(BenchmarkSession(watermark = watermark)), S3_PREFIX
+                              , 'RAW', 'PUBLIC', 'VACCINATION')
+
+    assert [file['Key'] for file in files][:1] == [synthetic_key(8)]
+    assert len(files) == 5000 - 8
+
+def test_unprocessed_files_lists_everything_when_keys_have_no_date(capsys):
+    local = LocalS3()
+    local.keys = sorted(f"{S3_PREFIX}{1711917526756 + number * 1000}_0.jsonl" for number in range(10))
+    watermark = (1711917526756 + 4000, 0)
+
+    files = unprocessed_files(client(local), snowflake_client(BenchmarkSession(watermark = watermark)), S3_PREFIX
+                              , 'RAW', 'PUBLIC', 'VACCINATION')
+
+    assert [file['Key'] for file in files] == local.keys[5:]
+    assert 'listing all the keys' in capsys.readouterr().out
+
+def test_iter_files_parallel_yields_shards_in_key_order():
+    s3 = client(LocalS3(listing = 20000))
+    shards = date_prefixes(S3_PREFIX, date(2024, 3, 31), date(2024, 4, 1))
+
+    keys = [obj['Key'] for obj in s3.iter_files_parallel(S3_PREFIX, sub_prefixes = shards, max_workers = 2
+                                                          , page_size = 500)]
+
+    assert keys == [obj['Key'] for obj in s3.iter_files(S3_PREFIX)]
+
+def test_iter_files_parallel_stops_listing_when_closed():
+    local = LocalS3(listing = 20000)
+    listing = client(local).iter_files_parallel(S3_PREFIX, sub_prefixes = [S3_PREFIX], page_size = 100
+                                                , pages_in_flight = 2)
+
+    assert [next(listing)['Key'] for _ in range(10)] == [synthetic_key(position) for position in range(10)]
+    listing.close()
+
+    # Page being yielded + pages_in_flight queued + one waiting to be queued
+    assert local.calls['list'] <= 4
+
+class FailingPaginator:
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, **kwargs):
+        raise RuntimeError('access denied')
+
+def test_iter_files_parallel_raises_shard_errors():
+    with pytest.raises(RuntimeError, match = 'access denied'):
+        list(client(FailingPaginator()).iter_files_parallel(S3_PREFIX, sub_prefixes = [S3_PREFIX]))
+
+def test_file_manifest_sorts_and_skips_unmatched_keys():
+    objects = [{'Key': 'x/2024_03_31_1711917526000_10.jsonl', 'Size': 3}, {'Key': 'x/_SUCCESS', 'Size': 0}
+               , {'Key': 'x/2024_03_31_1711917526000_9.jsonl', 'Size': 2}, {'Key': 'x/2024_03_31_1711917525000_0.jsonl', 'Size': 1}]
+
+    manifest = FileManifest.from_objects(objects)
+
+    assert [(file['unix_timestamp'], file['index']) for file in manifest] == \
+        [(1711917525000, 0), (1711917526000, 9), (1711917526000, 10)]
+    assert manifest.unmatched == ['x/_SUCCESS']
+    assert [file['Key'] for file in manifest.after((1711917526000, 9))] == ['x/2024_03_31_1711917526000_10.jsonl']
+    assert manifest.total_bytes() == 6
+    assert manifest.total_bytes(1) == 5
+
+def test_sort_files_reports_unmatched_keys(capsys):
+    manifest = sort_files(iter([{'Key': f"{S3_PREFIX}manifest.json", 'Size': 1}, {'Key': synthetic_key(0), 'Size': 2}]))
+
+    assert manifest.keys == [synthetic_key(0)]
+    assert manifest.after(None) is manifest
+    assert 'manifest.json' in capsys.readouterr().out
+
+def test_s3_range_reader_reads_ranges_and_caches_blocks():
+    data = bytes(range(256)) * 40
+    local = LocalS3(objects = {'key': data})
+    reader = S3RangeReader(local, 'benchmark', 'key', block_size = 1024, cache_blocks = 2)
+
+    reader.seek(-10, io.SEEK_END)
+    assert reader.read() == data[-10:]
+    reader.seek(5)
+    assert reader.read(20) == data[5:25]
+    gets = local.calls['get']
+    reader.seek(100)
+    assert reader.read(10) == data[100:110]
+    assert local.calls['get'] == gets
+
+    # Bigger than the cache , read directly
+    reader.seek(0)
+    assert reader.read() == data
+    with pytest.raises(ValueError):
+        reader.seek(-1)
+
+def test_fetch_parquet_downloads_only_the_columns_read():
+    pq = pytest.importorskip('pyarrow.parquet')
+    data = parquet_payload(50000)
+    s3 = client(LocalS3(objects = {'payload.parquet': data}))
+
+    reader = s3.fetch_parquet('payload.parquet', block_size = 64 * 1024)
+    table = pq.read_table(reader, columns = ['State'])
+
+    assert table.num_rows == 50000
+    assert reader.bytes_fetched < len(data) / 2
+
+def test_iter_jsonl_batches_joins_lines_split_across_chunks():
+    body = io.BytesIO(b'{"a": 1}\n\n{"a": 2}\n{"a": 3}\n  \n{"a": 4}')
+
+    batches = list(iter_jsonl_batches(body, batch_size = 3, chunk_size = 5))
+
+    assert batches == [[b'{"a": 1}', b'{"a": 2}', b'{"a": 3}'], [b'{"a": 4}']]
+
+class RecordingSnowflake:
+    """
+    SnowflakeClient stand-in , write_to_snowflake keeps (table , rows , first FILE_ROW_NUMBER) per batch
+    """
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.writes = []
+
+    def write_to_snowflake(self, frame, table, database, schema):
+        if self.fail:
+            raise RuntimeError('write failed')
+        self.writes.append((table, len(frame), frame['File_Source'].iloc[0], int(frame['FILE_ROW_NUMBER'].iloc[0])))
+
+def test_load_jsonl_files_streams_every_batch():
+    pytest.importorskip('pandas')
+    objects = {'a.jsonl': jsonl_payload(25), 'b.jsonl': jsonl_payload(10)}
+    snowflake = RecordingSnowflake()
+
+    summary = load_jsonl_files(client(LocalS3(objects = objects)), snowflake, list(objects), 'VACCINATION', 'RAW'
+                               , 'PUBLIC', batch_size = 10, fetch_concurrency = 2, queue_size = 1)
+
+    assert summary == {'files': 2, 'batches': 4, 'rows': 35, 'error_rows': 0}
+    assert sorted(write[2:] for write in snowflake.writes) == [('a.jsonl', 1), ('a.jsonl', 11), ('a.jsonl', 21)
+                                                               , ('b.jsonl', 1)]
+
+def test_load_jsonl_files_raises_when_a_stage_fails():
+    pytest.importorskip('pandas')
+    objects = {f"{number}.jsonl": jsonl_payload(20) for number in range(5)}
+
+    with pytest.raises(RuntimeError, match = 'write failed'):
+        load_jsonl_files(client(LocalS3(objects = objects)), RecordingSnowflake(fail = True), list(objects)
+                         , 'VACCINATION', 'RAW', 'PUBLIC', batch_size = 5, queue_size = 1)
+
+def test_load_jsonl_files_needs_error_table_with_transform():
+    with pytest.raises(ValueError):
+        load_jsonl_files(client(LocalS3()), RecordingSnowflake(), [], 'VACCINATION', 'RAW', 'PUBLIC'
+                         , transform = lambda table: table)
+
+class FlakyFile:
+    """
+    session.file stand-in , PUT fails failures times before it succeeds
+    """
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.puts = 0
+
+    def put(self, local_file, stage_location, **kwargs):
+        self.puts += 1
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('upload failed')
+
+def bulk_writer(failures: int) -> SnowflakeClient:
+    session = BenchmarkSession()
+    session.file = FlakyFile(failures)
+    snowflake = SnowflakeClient(None, None, None, None)
+    snowflake.session = session
+    return snowflake
+
+def test_write_to_snowflake_retries_failed_uploads():
+    pd = pytest.importorskip('pandas')
+    pytest.importorskip('pyarrow')
+    snowflake = bulk_writer(failures = 1)
+
+    result = snowflake.write_to_snowflake(pd.DataFrame(list(synthetic_rows(25))), 'VACCINATION', 'RAW', 'PUBLIC'
+                                          , chunk = 10, max_workers = 1, backoff = 0)
+
+    assert (result['rows'], result['chunks'], result['failures']) == (25, 3, {})
+    assert snowflake.session.file.puts == 4
+    statements = [statement.split()[0] for statement in snowflake.session.statements]
+    assert statements == ['CREATE', 'COPY', 'DROP']
+
+def test_write_to_snowflake_raises_bulk_write_error_without_loading():
+    pd = pytest.importorskip('pandas')
+    pytest.importorskip('pyarrow')
+    snowflake = bulk_writer(failures = 100)
+
+    with pytest.raises(BulkWriteError) as error:
+        snowflake.write_to_snowflake(pd.DataFrame(list(synthetic_rows(5))), 'VACCINATION', 'RAW', 'PUBLIC'
+                                     , max_workers = 1, retries = 2, backoff = 0)
+
+    assert list(error.value.result['failures']) == ['VACCINATION_0.parquet']
+    assert snowflake.session.file.puts == 3
+    assert [statement.split()[0] for statement in snowflake.session.statements] == ['CREATE', 'DROP']
+
+class ClosableSession(FailingSession):
+    def __init__(self, fail_on: dict = None):
+        super().__init__(fail_on or {})
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def session_pool(sessions: list, **kwargs) -> SessionPool:
+    created = iter(sessions)
+    return SessionPool({}, session_factory = lambda parameters: next(created), **kwargs)
+
+def test_session_pool_reuses_sessions_up_to_its_size():
+    first, second = ClosableSession(), ClosableSession()
+    pool = session_pool([first, second], size = 2)
+
+    pooled = pool.acquire()
+    pool.release(pooled)
+    assert pool.acquire() is pooled
+    assert pool.acquire().session is second
+    with pytest.raises(TimeoutError):
+        pool.acquire(timeout = 0)
+
+def test_session_pool_closes_idle_and_replaces_unhealthy_sessions():
+    idle, broken, new = ClosableSession(), ClosableSession({'SELECT 1': 1}), ClosableSession()
+    pool = session_pool([idle, broken, new], size = 2, idle_timeout = 600, health_check_after = 60)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    first.last_used -= 601
+    second.last_used -= 61
+
+    pooled = pool.acquire()
+
+    assert idle.closed and broken.closed
+    assert pooled.session is new
+    assert pool.open_sessions == 1
+
+def test_snowflake_client_skips_repeated_use_and_rolls_back_on_error():
+    session = ClosableSession()
+    snowflake = SnowflakeClient(None, None, None, None, pool = session_pool([session], size = 1))
+
+    with snowflake:
+        snowflake.execute_query('Select 1', 'RAW', 'PUBLIC')
+        snowflake.execute_query('Select 2', 'RAW', 'PUBLIC')
+    with pytest.raises(ZeroDivisionError):
+        with snowflake:
+            snowflake.execute_query('Select 3', 'RAW', 'PUBLIC')
+            1 / 0
+
+    assert session.statements == ['begin;', 'USE RAW.PUBLIC', 'Select 1', 'Select 2', 'commit;'
+                                  , 'begin;', 'Select 3', 'rollback;']
+    assert len(snowflake.pool.idle) == 1
+
+def test_schema_cache_expires_by_ttl_and_version(tmp_path):
+    path = str(tmp_path / 'schema_cache.json')
+    cache = SchemaCache(ttl = 60, path = path, version = 'v1')
+    cache.put('raw', 'public', 'issues', {'ID': 'NUMBER'})
+    cache.put('raw', 'public', 'goals', {'ID': 'NUMBER'})
+
+    assert SchemaCache(ttl = 60, path = path, version = 'v1').get('RAW', 'PUBLIC', 'ISSUES') == {'ID': 'NUMBER'}
+    assert SchemaCache(ttl = 60, path = path, version = 'v2').get('RAW', 'PUBLIC', 'ISSUES') is None
+
+    cache.entries['RAW.PUBLIC.ISSUES']['fetched_at'] -= 61
+    assert cache.get('RAW', 'PUBLIC', 'ISSUES') is None
+
+    cache.invalidate('raw', table_name = 'goals')
+    assert SchemaCache(ttl = 60, path = path, version = 'v1').get('RAW', 'PUBLIC', 'GOALS') is None
+
+class ColumnsSession(ClosableSession):
+    def _result(self, query):
+        if 'INFORMATION_SCHEMA.COLUMNS' in query:
+            return [SimpleNamespace(TABLE_NAME = table, COLUMN_NAME = 'ID', DATA_TYPE = 'NUMBER')
+                    for table in ('issues', 'goals') if f"'{table}'" in query]
+        return super()._result(query)
+
+def test_table_schema_fetches_missing_tables_in_one_query():
+    session = ColumnsSession()
+    snowflake = SnowflakeClient(None, None, None, None, pool = session_pool([session], size = 1))
+
+    with snowflake:
+        assert snowflake.table_schema(['issues'], 'RAW', 'PUBLIC') == {'issues': {'ID': 'NUMBER'}}
+        assert snowflake.table_schema(['issues', 'goals'], 'RAW', 'PUBLIC') == {'issues': {'ID': 'NUMBER'}
+                                                                               , 'goals': {'ID': 'NUMBER'}}
+        with pytest.raises(ValueError):
+            snowflake.table_schema(['missing'], 'RAW', 'PUBLIC')
+
+    queries = [statement for statement in session.statements if 'INFORMATION_SCHEMA.COLUMNS' in statement]
+    assert len(queries) == 3
+    assert "'issues'" not in queries[1] and "'goals'" in queries[1]
+
+def test_merge_statement_keeps_newest_file_row_and_hashes_only_data_columns():
+    columns = {'Customer_Id': 'TEXT(18)', 'Name': 'TEXT(255)', 'File_Source': 'TEXT(450)', 'FILE_ROW_NUMBER': 'Number(8,0)'
+               , 'ETL_Batch_ID': 'Number(15,0)', 'Loaded_At': 'TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP()'}
+
+    statement = SnowflakeClient(None, None, None, None).merge_statement('TEMP_customers', 'customers', columns
+                                                                        , ['Customer_Id'])
+
+    assert 'PARTITION BY Customer_Id' in statement
+    order_by = statement.split('ORDER BY')[1].split(') = 1')[0]
+    assert order_by.index("SPLIT_PART(REGEXP_SUBSTR(File_Source, '\\\\d{5,}_\\\\d+'), '_', 1)") \
+        < order_by.index("'_', 2)") < order_by.index('File_Source DESC') < order_by.index('FILE_ROW_NUMBER DESC')
+    assert 'HASH(Name) as ROW_HASH' in statement
+    assert 'WHEN MATCHED AND HASH(t.Name) <> s.ROW_HASH THEN' in statement
+    assert 'INSERT (Customer_Id,Name,File_Source,FILE_ROW_NUMBER,ETL_Batch_ID,Loaded_At)' in statement
+
+def test_merge_statement_without_value_columns_only_inserts():
+    statement = SnowflakeClient(None, None, None, None).merge_statement('TEMP_keys', 'keys', ['Id'], ['Id'])
+
+    assert 'WHEN MATCHED' not in statement
+    assert 'ORDER BY Id' in statement
@@ -0,0 +1,72 @@
+import csv
+import json
+from types import SimpleNamespace
+
+import pytest
+from conftest import FailingSession
+
+from pipeline_summary import SUMMARY_COLUMNS, PipelineSummary
+from vaccination_data_pipeline import PlanSession, main
+
+class QueryHistory:
+    """
+    session.query_history() stand-in , queries are the statements sent inside the with block
+    """
+    def __init__(self, session):
+        self.session = session
+        self.queries = []
+
+    def __enter__(self):
+        self.sent = len(self.session.statements)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.queries = [SimpleNamespace(query_id = f"plan-{number + 1}")
+                        for number in range(self.sent, len(self.session.statements))]
+        return False
+
+class HistorySession(PlanSession):
+    def query_history(self):
+        return QueryHistory(self)
+
+def test_step_records_status_query_ids_and_tag():
+    session = HistorySession()
+    summary = PipelineSummary(7, 'test', session)
+
+    with summary.step('copy') as step:
+        session.sql('Copy into A').collect()
+        step['rows_loaded'] = 10
+    tag = json.loads(session.query_tag)
+    with pytest.raises(RuntimeError):
+        with summary.step('fan_out', tag = False):
+            raise RuntimeError('insert failed')
+
+    assert tag == {'ETL_Batch_ID': 7, 'pipeline': 'test', 'step': 'copy'}
+    assert json.loads(session.query_tag)['step'] == 'copy'
+    copy, fan_out = summary.steps
+    assert (copy['status'], copy['rows_loaded'], copy['query_ids']) == ('SUCCESS', 10, ['plan-1'])
+    assert (fan_out['status'], fan_out['details']) == ('FAILED', {'error': 'insert failed'})
+
+def test_flush_writes_table_and_files(tmp_path):
+    session = PlanSession()
+    summary = PipelineSummary(7, 'test')
+    with summary.step('list_files') as step:
+        step['details']['lt_modified'] = "it's"
+
+    summary.flush(session = session, table = 'PIPELINE_SUMMARY', path = str(tmp_path / 'summary.json'))
+    summary.flush(path = str(tmp_path / 'summary.csv'))
+
+    assert session.statements[0].startswith('CREATE TABLE IF NOT EXISTS PIPELINE_SUMMARY')
+    assert """PARSE_JSON('{"lt_modified": "it''s"}')""" in session.statements[1]
+    assert json.load(open(tmp_path / 'summary.json'))['steps'][0]['step'] == 'list_files'
+    with open(tmp_path / 'summary.csv', newline = '') as file:
+        rows = list(csv.reader(file))
+    assert rows[0] == SUMMARY_COLUMNS and rows[1][:4] == ['7', 'test', 'list_files', 'SUCCESS']
+
+def test_main_raises_the_step_error_when_summary_cannot_be_written(capsys):
+    session = FailingSession({'ALTER STAGE': 1, 'Insert into PIPELINE_SUMMARY': 1})
+
+    with pytest.raises(RuntimeError, match = 'ALTER STAGE'):
+        main(session, script = 'dev')
+
+    assert 'Error writing Pipeline Summary' in capsys.readouterr().out
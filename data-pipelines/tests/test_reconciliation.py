@@ -0,0 +1,36 @@
+from reconciliation import checksum_columns, mismatched_files, reconciliation_statement
+from vaccination_data_pipeline import PlanRow
+
+COLUMNS = {'Country': 'TEXT(5)', 'Open_Date': 'DATE NOT NULL', 'Loaded_At': 'TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()'
+           , 'File_Source': 'TEXT(450) NOT NULL', 'ETL_Batch_ID': 'Number(15,0) NOT NULL'}
+
+def test_checksum_columns_cast_to_the_schema_type():
+    assert checksum_columns(COLUMNS) == ['Country::TEXT(5)', 'Open_Date::DATE', 'File_Source::TEXT(450)']
+
+def test_reconciliation_statement_compares_staging_with_target_and_error_tables():
+    statement = reconciliation_statement(COLUMNS, 'STG.TEMP_stg_vacination', ['PRD.v', 'PRD.v_IND'], 'PRD.error_data', 7)
+
+    assert "CASE WHEN COUNTRY IS NULL THEN 'ERROR' ELSE 'TARGET' END as DESTINATION" in statement
+    assert "Select 'TARGET' as DESTINATION, Country, Open_Date, File_Source from PRD.v_IND where ETL_Batch_ID = 7" in statement
+    assert "Select 'ERROR' as DESTINATION, Country, Open_Date, File_Source from PRD.error_data where ETL_Batch_ID = 7" in statement
+    assert 'HASH_AGG(Country::TEXT(5), Open_Date::DATE, File_Source::TEXT(450))' in statement
+    assert 'full outer join LOADED l on s.File_Source = l.File_Source and s.DESTINATION = l.DESTINATION' in statement
+
+def test_reconciliation_statement_without_error_table_has_only_target_side():
+    statement = reconciliation_statement(COLUMNS, 'STG.TEMP_a', ['PRD.a'], None, 7)
+
+    assert "'TARGET' as DESTINATION, count(*)" in statement
+    assert "'ERROR'" not in statement
+
+def test_mismatched_files_groups_destinations_per_file():
+    rows = [PlanRow(file_source = 'a.jsonl', destination = 'TARGET', staged_rows = 3, loaded_rows = None
+                    , staged_checksum = 1, loaded_checksum = None)
+            , PlanRow(FILE_SOURCE = 'a.jsonl', DESTINATION = 'ERROR', STAGED_ROWS = None, LOADED_ROWS = 1
+                      , STAGED_CHECKSUM = None, LOADED_CHECKSUM = 2)]
+
+    mismatches = mismatched_files(rows)
+
+    assert list(mismatches) == ['a.jsonl']
+    assert [(item['destination'], item['staged_rows'], item['loaded_rows']) for item in mismatches['a.jsonl']] == \
+        [('TARGET', 3, 0), ('ERROR', 0, 1)]
+    assert mismatched_files([]) == {}
@@ -0,0 +1,108 @@
+import copy
+import os
+
+from common import SessionPool
+from conftest import FailingSession
+from scheduler import PipelineScheduler
+from vaccination_data_pipeline import PlanResult, PlanSession, load_json_file
+
+PARAMETERS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pipeline_parameters.json')
+
+COLUMNS = {'Country': 'TEXT(5)', 'File_Source': 'TEXT(450) NOT NULL', 'ETL_Batch_ID': 'Number(15,0) NOT NULL'}
+
+class FailedCopy(PlanResult):
+    def result(self):
+        raise RuntimeError('copy failed')
+
+class FailingCopySession(PlanSession):
+    def sql(self, query):
+        if query.lstrip().startswith('Copy into'):
+            self.statements.append(query)
+            return FailedCopy([], 'copy')
+        return super().sql(query)
+
+def scheduler_for(session, tables = ('A', 'B'), retries = 0) -> PipelineScheduler:
+    script_parameters = copy.deepcopy(load_json_file(PARAMETERS)['dev'])
+    script_parameters['retries'] = retries
+    script_parameters['tables'] = {table: {'staging_table': f"stg_{table.lower()}", 'target_table': table.lower()}
+                                   for table in tables}
+    pool = SessionPool({}, size = 1, session_factory = lambda parameters: session)
+    return PipelineScheduler(pool, {'dev': script_parameters}, {'dev': {table: COLUMNS for table in tables}}, 1
+                             , backoff = 0)
+
+def files(*tables):
+    return [f"stg_{table.lower()}/2024_03_31_1711917526756_0.jsonl" for table in tables]
+
+def test_failed_task_skips_its_dependents_only():
+    # Directory listing of table A fails , table B keeps loading
+    session = FailingSession({"startswith(d.RELATIVE_PATH , 'stg_a/')": 1}, files = files('B'), countries = ['IND'])
+    scheduler = scheduler_for(session)
+
+    statuses = scheduler.run()
+
+    assert statuses['dev.refresh'] == 'SUCCESS'
+    assert statuses['dev.A.list'] == 'FAILED'
+    assert statuses['dev.A.copy'] == 'SKIPPED'
+    assert statuses['dev.A.fan_out'] == 'SKIPPED'
+    assert [statuses[f"dev.B.{step}"] for step in ('list', 'copy', 'fan_out')] == ['SUCCESS'] * 3
+
+def test_failed_task_is_retried():
+    session = FailingSession({"startswith(d.RELATIVE_PATH , 'stg_a/')": 1}, files = files('A'), countries = ['IND'])
+    scheduler = scheduler_for(session, tables = ('A',), retries = 1)
+
+    statuses = scheduler.run()
+
+    assert set(statuses.values()) == {'SUCCESS'}
+    assert scheduler.tasks['dev.A.list'].attempts == 2
+
+def test_copy_failures_are_retried_and_reported():
+    session = FailingCopySession(files = files('A'), countries = ['IND'])
+    scheduler = scheduler_for(session, tables = ('A',), retries = 1)
+
+    scheduler.run()
+
+    task = scheduler.tasks['dev.A.copy']
+    assert task.attempts == 2
+    assert sorted(task.result['failures']) == [0]
+
+def test_fan_out_retry_clears_the_earlier_attempt():
+    session = FailingSession({'Insert into S3_FILES': 1}, files = files('A'), countries = ['IND'])
+    scheduler = scheduler_for(session, tables = ('A',), retries = 1)
+
+    assert scheduler.run()['dev.A.fan_out'] == 'SUCCESS'
+
+    retry = session.statements[max(number for number, statement in enumerate(session.statements) if statement == 'begin;'):]
+    insert = next(number for number, statement in enumerate(retry) if 'INSERT FIRST' in statement)
+    assert any(statement.startswith('Delete from PRD.a where ETL_Batch_ID = 1') for statement in retry[:insert])
+    assert retry[-1] == 'commit;'
+
+def environments(prod_parameters: dict) -> dict:
+    parameters = load_json_file(PARAMETERS)
+    parameters['prod'].update(prod_parameters)
+    for script_parameters in parameters.values():
+        script_parameters['tables'] = {'A': {'staging_table': 'stg_a', 'target_table': 'a'}}
+    return parameters
+
+def test_environments_sharing_tables_run_one_after_another():
+    session = PlanSession(files = files('A'), countries = ['IND'])
+    pool = SessionPool({}, size = 2, session_factory = lambda parameters: session)
+    parameters = environments({})
+    scheduler = PipelineScheduler(pool, parameters, {env: {'A': COLUMNS} for env in parameters}, 100, backoff = 0)
+
+    assert set(scheduler.run().values()) == {'SUCCESS'}
+
+    assert scheduler.batch_ids == {'prod': 100, 'dev': 101}
+    assert scheduler.tasks['dev.refresh'].after == [f"prod.{name}" for name in ('refresh', 'A.list', 'A.copy', 'A.fan_out')]
+    refreshes = [number for number, statement in enumerate(session.statements) if 'ALTER STAGE' in statement]
+    prod_fan_out = [number for number, statement in enumerate(session.statements) if 'INSERT FIRST' in statement][0]
+    assert refreshes[0] < prod_fan_out < refreshes[1]
+    fan_outs = [statement for statement in session.statements if 'INSERT FIRST' in statement]
+    assert ['100 as ETL_Batch_ID' in statement for statement in fan_outs] == [True, False]
+    assert '101 as ETL_Batch_ID' in fan_outs[1]
+
+def test_environments_with_own_tables_do_not_wait():
+    pool = SessionPool({}, size = 2, session_factory = lambda parameters: PlanSession())
+    parameters = environments({'temp_schema': 'STG_PRD.', 'target_database': 'PRD2.', 'history_table': 'S3_FILES_PRD'})
+    scheduler = PipelineScheduler(pool, parameters, {env: {'A': COLUMNS} for env in parameters}, 100, backoff = 0)
+
+    assert scheduler.tasks['dev.refresh'].after == []
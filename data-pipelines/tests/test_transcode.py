@@ -0,0 +1,44 @@
+import json
+import os
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+from benchmark import LocalS3, jsonl_payload
+from common import jsonl_table, s3_client
+from transcode import conform, parquet_schema, transcode_file
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'table_schema.json')
+
+with open(SCHEMA) as file:
+    COLUMNS = json.load(file)['VACCINATION_TABLE']
+
+def test_parquet_schema_keeps_source_text_for_dates_and_booleans():
+    schema = parquet_schema(COLUMNS)
+
+    assert 'Last_Updated_Timestamp' not in schema.names and 'ETL_Batch_ID' not in schema.names
+    assert schema.field('Open_Date').type == pa.string() and schema.field('Is_Active').type == pa.string()
+    assert schema.field('Age').type == pa.int64()
+
+def test_conform_matches_keys_case_insensitive():
+    table = jsonl_table('stg_vacination/a.jsonl', 1, [b'{"customer_name": "Alex", "open_date": 20101012, "Extra": 1}'])
+
+    conformed = conform(table, parquet_schema(COLUMNS))
+
+    row = conformed.to_pylist()[0]
+    assert (row['Customer_Name'], row['Open_Date'], row['Country']) == ('Alex', '20101012', None)
+    assert (row['File_Source'], row['FILE_ROW_NUMBER']) == ('stg_vacination/a.jsonl', 1)
+    assert 'Extra' not in conformed.column_names
+
+def test_transcode_file_writes_one_row_group_per_batch(tmp_path):
+    s3 = s3_client('benchmark', None, None)
+    s3.s3_client = LocalS3(objects = {'raw/a.jsonl': jsonl_payload(25)})
+    path = str(tmp_path / 'a.parquet')
+
+    result = transcode_file(s3, 'raw/a.jsonl', 'stg_vacination/a.jsonl', COLUMNS, path, batch_size = 10)
+
+    parquet = pq.ParquetFile(path)
+    assert (result['rows'], parquet.metadata.num_row_groups) == (25, 3)
+    assert parquet.read(columns = ['FILE_ROW_NUMBER']).column(0).to_pylist() == list(range(1, 26))
@@ -0,0 +1,59 @@
+import json
+import os
+from datetime import date
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+
+from common import jsonl_table
+from transform import BatchTransform, error_table_creation
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'table_schema.json')
+
+with open(SCHEMA) as file:
+    COLUMNS = json.load(file)['VACCINATION_TABLE']
+
+def record(**values):
+    row = {'Customer_Name': 'Alex', 'Customer_Id': '123457', 'Open_Date': 20101012, 'Last_Consulted_Date': 20240320
+           , 'Vaccination_ID': 'MVD', 'Dr_Name': 'Paul', 'State': 'SA', 'Country': 'IND', 'DOB': 6031987}
+    row.update(values)
+    return json.dumps(row).encode()
+
+def test_batch_transform_derives_columns_from_integer_dates():
+    batch = jsonl_table('stg_vacination/a.jsonl', 1, [record(), record(Is_Active = 'N', Last_Consulted_Date = 20240101)])
+
+    result = BatchTransform(COLUMNS, as_of = date(2024, 3, 31), ETL_Batch_ID = 7)(batch)
+
+    valid = result['valid'].to_pylist()
+    assert (result['rows'], result['error_rows']) == (2, 0)
+    assert valid[0]['DOB'] == date(1987, 3, 6) and valid[0]['Open_Date'] == date(2010, 10, 12)
+    assert [row['Age'] for row in valid] == [37, 37]
+    assert [row['Days_Since_Consultation'] for row in valid] == [11, 90]
+    # Source Is_Active wins , otherwise consulted within 30 days
+    assert [row['Is_Active'] for row in valid] == [True, False]
+    assert [row['ETL_Batch_ID'] for row in valid] == [7, 7]
+    assert 'Last_Updated_Timestamp' not in result['valid'].column_names
+
+def test_batch_transform_splits_out_failed_rows_with_reasons():
+    batch = jsonl_table('stg_vacination/a.jsonl', 1, [record(), record(Open_Date = 20101399, State = 'TOOLONG')
+                                                      , record(Customer_Id = None)])
+
+    result = BatchTransform(COLUMNS, as_of = date(2024, 3, 31))(batch)
+
+    errors = result['errors'].to_pylist()
+    assert (result['valid'].num_rows, result['error_rows']) == (1, 2)
+    assert [row['FILE_ROW_NUMBER'] for row in errors] == [2, 3]
+    # Open_Date is NOT NULL , so an unparsable date is also reported as null
+    assert errors[0]['Error_Reason'] == 'Open_Date invalid date; State longer than 5; Open_Date is null'
+    assert errors[1]['Error_Reason'] == 'Customer_Id is null'
+    assert errors[0]['OPEN_DATE'] == '20101399'
+    # ETL_Batch_ID is set later by the fan out , so it is not checked
+    assert 'ETL_Batch_ID' not in errors[1]['Error_Reason']
+
+def test_error_table_creation_keeps_source_columns_as_text():
+    statement = error_table_creation(COLUMNS, 'PRD.error_vaccination')
+
+    assert statement.startswith('CREATE TABLE IF NOT EXISTS PRD.error_vaccination (Customer_Name TEXT,')
+    assert 'Last_Updated_Timestamp' not in statement
+    assert statement.endswith('FILE_ROW_NUMBER NUMBER(15,0), ETL_Batch_ID NUMBER(15,0), Error_Reason TEXT);')
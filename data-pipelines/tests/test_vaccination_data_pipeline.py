@@ -0,0 +1,216 @@
+import pytest
+from conftest import FailingSession
+
+from pipeline_summary import PipelineSummary
+from reconciliation import delete_files_statements
+from vaccination_data_pipeline import (MAX_FILES_PER_COPY, PlanRow, PlanSession, cli, copy_step, execute_async, fan_out_statement
+                                       , fan_out_step, list_files, plan_copy_batches, reconcile_step
+                                       , record_files_statements)
+
+SCRIPT_PARAMETERS = {'temp_schema': 'STG.', 'target_database': 'PRD.', 'history_table': 'S3_FILES', 'reconcile': True}
+COLUMNS = {'Country': 'TEXT(5)', 'File_Source': 'TEXT(450) NOT NULL', 'ETL_Batch_ID': 'Number(15,0) NOT NULL'}
+NAMES = {'staging': 'stg_vacination', 'target': 'vaccination_data', 'error': 'error_data'}
+
+def file_row(timestamp, index, size = 0):
+    return {'FILE_NAME': f"stg_vacination/2024_03_31_{timestamp}_{index}.jsonl", 'SIZE': size
+            , 'UNIX_TIMESTAMP': timestamp, 'FILE_INDEX': index}
+
+class Job:
+    """
+    AsyncJob stand-in , done after polls is_done() calls
+    """
+    def __init__(self, query_id, polls = 0, error = None):
+        self.query_id = query_id
+        self.polls = polls
+        self.error = error
+        self.session = None
+
+    def is_done(self):
+        self.polls -= 1
+        if self.polls < 0 and self in self.session.running:
+            self.session.running.remove(self)
+        return self.polls < 0
+
+    def result(self):
+        if self.error:
+            raise self.error
+        return [{'rows_loaded': 1}]
+
+class AsyncSession:
+    """
+    Session stand-in for collect_nowait , statement --> Job (or exception raised on submit)
+    """
+    def __init__(self, jobs: dict):
+        self.jobs = jobs
+        self.running = []
+        self.max_running = 0
+
+    def sql(self, statement):
+        return Submit(self, statement)
+
+    def submit(self, statement):
+        job = self.jobs[statement]
+        if isinstance(job, Exception):
+            raise job
+        job.session = self
+        self.running.append(job)
+        self.max_running = max(self.max_running, len(self.running))
+        return job
+
+class Submit:
+    def __init__(self, session, statement):
+        self.session = session
+        self.statement = statement
+
+    def collect_nowait(self):
+        return self.session.submit(self.statement)
+
+def test_execute_async_collects_results_and_failures():
+    session = AsyncSession({'copy 0': Job('q0', polls = 2), 'copy 1': RuntimeError('submit failed')
+                            , 'copy 2': Job('q2', error = RuntimeError('copy failed')), 'copy 3': Job('q3')})
+
+    summary = execute_async(session, ['copy 0', 'copy 1', 'copy 2', 'copy 3'], max_in_flight = 2, poll_interval = 0)
+
+    assert sorted(summary['results']) == [0, 3]
+    assert sorted(summary['failures']) == [1, 2]
+    assert str(summary['failures'][2]) == 'copy failed'
+    assert summary['query_ids'] == {0: 'q0', 2: 'q2', 3: 'q3'}
+    assert session.max_running == 2
+
+def test_reconcile_step_flags_loaded_files_without_staged_rows():
+    skipped = {'FILE_NAME': 'stg_vacination/2024_03_31_1711917526000_0.jsonl', 'SIZE': 10}
+    empty = {'FILE_NAME': 'stg_vacination/2024_03_31_1711917526000_1.jsonl', 'SIZE': 0}
+    session = PlanSession()
+
+    mismatches = reconcile_step(session, PipelineSummary(1, 'test'), SCRIPT_PARAMETERS, 1, COLUMNS, 'stg_vacination'
+                                , ['PRD.vaccination_data'], 'PRD.error_data', [skipped, empty])
+
+    assert list(mismatches) == [skipped['FILE_NAME']]
+    assert mismatches[skipped['FILE_NAME']][0]['destination'] == 'STAGING'
+    ledger = [statement for statement in session.statements if statement.startswith('Insert into S3_FILES')]
+    assert len(ledger) == 1 and "'MISMATCHED'" in ledger[0] and empty['FILE_NAME'] not in ledger[0]
+
+def test_list_files_lists_failed_ledger_files_again():
+    session = PlanSession()
+
+    list_files(session, '@AWS_DEV', '2024-03-31', history_table = 'S3_FILES', folder = 'stg_vacination')
+
+    query = session.statements[-1]
+    assert "STATUS in ('FAILED', 'MISMATCHED')" in query
+    assert "(h.IS_PROCESSED = True or h.STATUS = 'QUARANTINED')" in query
+    assert 'coalesce(f.ATTEMPTS, 0) as attempts' in query
+
+def test_fan_out_step_rolls_back_when_ledger_insert_fails():
+    session = FailingSession({'Insert into S3_FILES': 1}, countries = ['IND'])
+
+    with pytest.raises(RuntimeError):
+        fan_out_step(session, PipelineSummary(1, 'test'), SCRIPT_PARAMETERS, 1, COLUMNS, NAMES
+                     , [file_row(1711917526000, 0)])
+
+    statements = [statement.strip().split()[0].lower() for statement in session.statements]
+    assert statements.index('begin;') < statements.index('insert') < statements.index('rollback;')
+    assert 'commit;' not in statements
+
+def test_ledger_inserts_and_deletes_are_chunked():
+    files = [file_row(1711917526000, number) for number in range(2500)]
+
+    inserts = record_files_statements('S3_FILES', files, 'stg_vacination', 1, 'LOADED')
+    deletes = delete_files_statements(['PRD.a', 'PRD.b'], 1, [file['FILE_NAME'] for file in files])
+
+    assert [statement.count('stg_vacination/') for statement in inserts] == [1000, 1000, 500]
+    assert [statement.count('stg_vacination/') for statement in deletes] == [1000, 1000, 500] * 2
+    assert [statement.split()[2] for statement in deletes] == ['PRD.a'] * 3 + ['PRD.b'] * 3
+
+def test_fan_out_step_records_loaded_files_per_batch():
+    session = PlanSession(countries = ['IND'])
+
+    fan_out_step(session, PipelineSummary(1, 'test'), dict(SCRIPT_PARAMETERS, reconcile = False), 1, COLUMNS, NAMES
+                 , [file_row(1711917526000, number) for number in range(1500)])
+
+    assert len([statement for statement in session.statements if statement.startswith('Insert into S3_FILES')]) == 2
+
+def test_plan_copy_batches_gives_retried_files_their_own_batch():
+    files = [file_row(1711917526000, number) for number in range(4)]
+    files[1]['ATTEMPTS'] = 1
+
+    assert [[file['FILE_INDEX'] for file in batch] for batch in plan_copy_batches(files)] == [[0], [1], [2, 3]]
+
+def test_copy_step_quarantines_files_failing_for_the_last_time(capsys):
+    script_parameters = dict(SCRIPT_PARAMETERS, stage = '@AWS_DEV', max_file_attempts = 3)
+    files = [file_row(1711917526000, 0), dict(file_row(1711917526000, 1), ATTEMPTS = 2)
+             , dict(file_row(1711917526000, 2), ATTEMPTS = 1)]
+    session = FailingSession({'Copy into': 3})
+
+    load_summary = copy_step(session, PipelineSummary(1, 'test'), script_parameters, 1, files, 'stg_vacination')
+
+    assert sorted(load_summary['failures']) == [0, 1, 2]
+    copies = [statement for statement in session.statements if statement.startswith('Copy into')]
+    assert ['FORCE = TRUE' in statement for statement in copies] == [False, True, True]
+    ledger = {statement.split("'")[1]: statement for statement in session.statements if statement.startswith('Insert into S3_FILES')}
+    assert "'FAILED'" in ledger[files[0]['FILE_NAME']] and "'FAILED'" in ledger[files[2]['FILE_NAME']]
+    assert "'QUARANTINED'" in ledger[files[1]['FILE_NAME']]
+    assert 'Quarantined 1 files' in capsys.readouterr().out
+
+def test_fan_out_statement_routes_null_country_first_and_unknown_countries_to_the_base_table():
+    statement = fan_out_statement(['Country', 'ETL_Batch_ID'], 'STG.TEMP_stg_vacination', 'PRD.vaccination_data'
+                                  , ['IND', "N'Z"], 'PRD.error_data', overrides = {'etl_batch_id': 7})
+
+    branches = statement.splitlines()
+    assert branches[0] == 'INSERT FIRST'
+    assert branches[1].strip().startswith('WHEN COUNTRY IS NULL THEN INTO PRD.error_data')
+    assert "WHEN COUNTRY = 'IND' THEN INTO PRD.vaccination_data_IND" in branches[2]
+    assert "WHEN COUNTRY = 'N''Z' THEN INTO PRD.vaccination_data_N_Z" in branches[3]
+    assert branches[4].strip().startswith('ELSE INTO PRD.vaccination_data ')
+    assert branches[5] == 'SELECT Country, 7 as ETL_Batch_ID FROM STG.TEMP_stg_vacination;'
+
+class ExistingTablesSession(PlanSession):
+    def _result(self, query):
+        if 'INFORMATION_SCHEMA.TABLES' in query:
+            return [PlanRow(TABLE_NAME='VACCINATION_DATA_IND'), PlanRow(TABLE_NAME='ERROR_DATA')]
+        return super()._result(query)
+
+def test_fan_out_step_creates_only_missing_tables():
+    session = ExistingTablesSession(countries = ['IND', 'USA'])
+
+    fan_out_step(session, PipelineSummary(1, 'test'), dict(SCRIPT_PARAMETERS, reconcile = False), 1, COLUMNS, NAMES
+                 , [file_row(1711917526000, 0)])
+
+    assert len([statement for statement in session.statements if 'INFORMATION_SCHEMA.TABLES' in statement]) == 1
+    assert [statement.split()[5] for statement in session.statements if statement.startswith('CREATE TABLE')] == \
+        ['PRD.vaccination_data_USA']
+
+def test_cli_plan_skips_files_without_timestamp(capsys):
+    cli(['--env', 'dev', '--plan', '--files', 'stg_vacination/_SUCCESS'
+         , 'stg_vacination/2024_03_31_1711917526756_0.jsonl', '--countries', 'IND'])
+
+    statements = capsys.readouterr().out.split(';\n\n')
+    copies = [statement for statement in statements if statement.startswith('Copy into')]
+    ledger = [statement for statement in statements if statement.startswith('Insert into S3_FILES')]
+    assert len(copies) == 1 and "('2024_03_31_1711917526756_0.jsonl')" in copies[0]
+    assert len(ledger) == 1 and '_SUCCESS' not in ledger[0]
+
+def test_plan_copy_batches_orders_by_timestamp_and_index():
+    files = [file_row(1711917527000, 0), file_row(1711917526000, 10), file_row(1711917526000, 9)]
+
+    batches = plan_copy_batches(files)
+
+    assert [(file['UNIX_TIMESTAMP'], file['FILE_INDEX']) for batch in batches for file in batch] == \
+        [(1711917526000, 9), (1711917526000, 10), (1711917527000, 0)]
+
+def test_plan_copy_batches_splits_by_bytes_and_file_count():
+    # XS has 8 load threads , 8 * 100 bytes per batch
+    files = [file_row(1711917526000 + number, 0, size = 300) for number in range(5)]
+
+    assert [len(batch) for batch in plan_copy_batches(files, 'XS', bytes_per_thread = 100)] == [2, 2, 1]
+    assert [len(batch) for batch in plan_copy_batches(files, max_files = 2)] == [2, 2, 1]
+    assert max(len(batch) for batch in plan_copy_batches([file_row(1, number) for number in range(1500)]
+                                                         , max_files = 5000)) == MAX_FILES_PER_COPY
+
+def test_plan_copy_batches_skips_files_without_timestamp(capsys):
+    files = [file_row(1711917526000, 1), {'FILE_NAME': 'stg_vacination/_SUCCESS', 'SIZE': 0
+                                          , 'UNIX_TIMESTAMP': None, 'FILE_INDEX': None}]
+
+    batches = plan_copy_batches(files)
+
+    assert [file['FILE_NAME'] for batch in batches for file in batch] == [files[0]['FILE_NAME']]
+    assert 'stg_vacination/_SUCCESS' in capsys.readouterr().out
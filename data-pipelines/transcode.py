@@ -0,0 +1,133 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from common import iter_jsonl_batches, jsonl_table
+from transform import column_rules
+
+############################################################################################################
+# JSONL --> Parquet transcoding before COPY
+# Newly listed json lines files are converted (process pool) into compressed Parquet files typed with
+# table_schema.json , so COPY reads smaller typed files instead of parsing JSON with MATCH_BY_COLUMN_NAME.
+# File_Source & FILE_ROW_NUMBER are written into the Parquet file (same values COPY adds from the JSON file)
+# Values are not transformed , a batch which falls back to the JSON COPY loads the same data
+############################################################################################################
+
+# Function to map a table_schema.json data type to an Arrow type
+# DATE & BOOLEAN are kept as the source text (e.g. 20101012 / 'A') , Snowflake converts them the same way as
+# the json value of the JSON COPY
+def arrow_type(rule: dict):
+    import pyarrow as pa
+
+    data_type = rule['type']
+    if data_type in ('DATE', 'BOOLEAN'):
+        return pa.string()
+    if data_type.startswith('TIMESTAMP'):
+        return pa.timestamp('us')
+    if data_type in ('FLOAT', 'DOUBLE', 'REAL'):
+        return pa.float64()
+    if data_type in ('NUMBER', 'NUMERIC', 'DECIMAL', 'INT', 'INTEGER', 'BIGINT'):
+        return pa.int64() if not rule['scale'] else pa.float64()
+    return pa.string()
+
+def parquet_schema(columns: dict):
+    """
+    Function to create the Arrow schema of the Parquet files from table_schema.json columns
+    Columns with DEFAULT & ETL_Batch_ID (set by the fan out) are not written
+    """
+    import pyarrow as pa
+
+    return pa.schema([(column, arrow_type(rule)) for column, rule in column_rules(columns).items()
+                      if not rule['default'] and column.upper() != 'ETL_BATCH_ID'])
+
+def conform(table, schema):
+    """
+    Function to cast a parsed json lines batch to the Parquet schema , json keys are matched case insensitive
+    Missing columns are Null & keys which are not in the schema are dropped (same as MATCH_BY_COLUMN_NAME)
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    source = {name.upper(): table.column(position) for position, name in enumerate(table.column_names)}
+
+    arrays = []
+    for field in schema:
+        values = source.get(field.name.upper())
+        if values is None:
+            arrays.append(pa.nulls(table.num_rows, field.type))
+        else:
+            arrays.append(pc.cast(values, field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def transcode_file(s3, file_key: str, file_source: str, columns: dict, path: str, compression: str = 'zstd'
+                   , batch_size: int = 100000) -> dict:
+    """
+    Function to convert one json lines S3 object into a Parquet file , one row group per batch
+    (runs in the process pool of transcode_files)
+
+    Attributes:
+        s3 :- s3_client
+        file_key (str) :- S3 key of the json lines file
+        file_source (str) :- Value of File_Source column (file name relative to the stage e.g. 'stg_vacination/x.jsonl')
+        columns (dict) :- Columns of the table from table_schema.json
+        path (str) :- Local path of the Parquet file
+        compression (str) :- Parquet compression , By Default 'zstd'
+        batch_size (int) :- Rows per row group , By Default 100,000
+    Output:
+        dict :- {'file_source', 'path', 'rows', 'parquet_bytes', 'seconds'}
+    """
+    import pyarrow.parquet as pq
+
+    start_time = time.perf_counter()
+    schema = parquet_schema(columns)
+    rows = 0
+    with pq.ParquetWriter(path, schema, compression=compression) as writer:
+        for lines in iter_jsonl_batches(s3.fetch_json(file_key), batch_size = batch_size):
+            writer.write_table(conform(jsonl_table(file_source, rows + 1, lines), schema))
+            rows += len(lines)
+    return {'file_source': file_source, 'path': path, 'rows': rows, 'parquet_bytes': os.path.getsize(path)
+            , 'seconds': time.perf_counter() - start_time}
+
+def transcode_files(s3, files: list, columns: dict, directory: str, prefix: str = '', compression: str = 'zstd'
+                    , max_workers: int = None) -> dict:
+    """
+    Function to transcode the listed files in a process pool
+
+    Attributes:
+        s3 :- s3_client (client is created again in every process)
+        files (list) :- Output of list_files (FILE_NAME relative to the stage , SIZE)
+        columns (dict) :- Columns of the table from table_schema.json
+        directory (str) :- Local directory for the Parquet files
+        prefix (str) :- S3 key of the stage location , key of a file is prefix + FILE_NAME
+        compression (str) :- Parquet compression , By Default 'zstd'
+        max_workers (int) :- Processes , By Default number of CPUs
+    Output:
+        dict :- FILE_NAME --> output of transcode_file (with 'json_bytes') or the exception of the file
+    """
+    paths = {file['FILE_NAME']: os.path.join(directory, f"{os.path.splitext(os.path.basename(file['FILE_NAME']))[0]}.parquet")
+             for file in files}
+    if len(set(paths.values())) != len(paths):
+        # Same file name in two folders , keep the folder in the Parquet name
+        paths = {file_name: os.path.join(directory, os.path.splitext(file_name)[0].replace('/', '__') + '.parquet')
+                 for file_name in paths}
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(transcode_file, s3, prefix + file['FILE_NAME'], file['FILE_NAME'], columns
+                                   , paths[file['FILE_NAME']], compression): file for file in files}
+        for future, file in futures.items():
+            try:
+                results[file['FILE_NAME']] = {**future.result(), 'json_bytes': file.get('SIZE') or 0}
+            except Exception as e:
+                print(f"Transcoding of {file['FILE_NAME']} failed : {e}")
+                results[file['FILE_NAME']] = e
+    return results
+
+# Function to Load the transcoded Parquet files into Snowflake Staged Table
+def parquet_copy_statement(table: str, files: list, database: str, stage: str) -> str:
+    files = ", ".join(f"'{file}'" for file in files)
+    return """Copy into {database}TEMP_{table}  FROM  '@{stage}/'
+                        FILE_FORMAT = (TYPE = 'PARQUET')
+                        FILES = ({files})
+                        MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+                        ON_ERROR=ABORT_STATEMENT; """.format(table=table, files=files, database=database, stage=stage)
@@ -0,0 +1,202 @@
+import re
+from datetime import date
+
+############################################################################################################
+# Pre-load transform of json lines batches (before write_to_snowflake)
+# 1. Integer dates (e.g. 20101012 / 06031987) are parsed into DATE
+# 2. Derived columns Age , Days_Since_Consultation & Is_Active are computed
+# 3. NOT NULL & TEXT(n) constraints of table_schema.json are checked , failed rows are split out with
+#    File_Source , FILE_ROW_NUMBER & the reason so they can be loaded into the error table
+# Every step is an Arrow compute kernel over the whole column (no python loop per row)
+############################################################################################################
+
+# Format of the integer dates per column , leading zeros (DDMMYYYY) are lost when stored as integer & added back
+DATE_FORMATS = {'Open_Date': '%Y%m%d', 'Last_Consulted_Date': '%Y%m%d', 'DOB': '%d%m%Y'}
+
+# Customer is active if consulted within these many days (when the source does not send Is_Active)
+ACTIVE_DAYS = 30
+
+# Values of a source Is_Active column which mean True
+ACTIVE_VALUES = ['A', 'Y', 'YES', 'T', 'TRUE', '1']
+
+ERROR_COLUMN = 'Error_Reason'
+
+TYPE_PATTERN = re.compile(r'\s*(\w+)\s*(?:\(\s*(\d+)\s*(?:,\s*(\d+)\s*)?\))?')
+
+# Function to read data type , TEXT(n) length & NOT NULL of every column of table_schema.json table
+def column_rules(columns: dict) -> dict:
+    rules = {}
+    for column, definition in columns.items():
+        match = TYPE_PATTERN.match(definition)
+        data_type = match.group(1).upper()
+        rules[column] = {'type': data_type
+                         , 'length': int(match.group(2)) if data_type in ('TEXT', 'VARCHAR', 'STRING', 'CHAR')
+                                                            and match.group(2) else None
+                         , 'scale': int(match.group(3) or 0) if data_type in ('NUMBER', 'NUMERIC', 'DECIMAL') else None
+                         , 'not_null': 'NOT NULL' in definition.upper()
+                         , 'default': 'DEFAULT' in definition.upper()}
+    return rules
+
+# Function to create the error table , every column is TEXT so rows which failed type checks can still be loaded
+def error_table_creation(columns: dict, error_table: str) -> str:
+    error_columns = [f"{column} TEXT" for column, rule in column_rules(columns).items()
+                     if column not in ('FILE_ROW_NUMBER', 'ETL_Batch_ID') and not rule['default']]
+    error_columns += ["FILE_ROW_NUMBER NUMBER(15,0)", "ETL_Batch_ID NUMBER(15,0)", f"{ERROR_COLUMN} TEXT"]
+    return f"CREATE TABLE IF NOT EXISTS {error_table} ({', '.join(error_columns)});"
+
+def parse_int_dates(values, date_format: str):
+    """
+    Function to parse a column of integer / text dates into date32 , values which can not be parsed become Null
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if pa.types.is_date(values.type):
+        return values
+    if pa.types.is_timestamp(values.type):
+        return pc.cast(values, pa.date32())
+    if pa.types.is_floating(values.type):
+        # Pandas keeps integer columns with Nulls as float
+        values = pc.cast(values, pa.int64(), safe=False)
+
+    text = pc.utf8_trim_whitespace(pc.cast(values, pa.string()))
+    text = pc.utf8_lpad(text, width=len(date(2000, 1, 1).strftime(date_format)), padding='0')
+    return pc.cast(pc.strptime(text, format=date_format, unit='s', error_is_null=True), pa.date32())
+
+def age_in_years(birth_dates, as_of: date):
+    """
+    Function to calculate completed years between birth_dates (date32 column) & as_of
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    years = pc.subtract(pa.scalar(as_of.year, pa.int64()), pc.year(birth_dates))
+    # One year less if birthday of as_of year is not reached yet
+    birthday = pc.add(pc.multiply(pc.month(birth_dates), 100), pc.day(birth_dates))
+    not_reached = pc.greater(birthday, as_of.month * 100 + as_of.day)
+    return pc.subtract(years, pc.cast(not_reached, pa.int64()))
+
+def to_boolean(values):
+    """
+    Function to convert a column of flags (A / Y / TRUE / 1 ...) into boolean , Null stays Null
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if pa.types.is_boolean(values.type):
+        return values
+    text = pc.utf8_upper(pc.utf8_trim_whitespace(pc.cast(values, pa.string())))
+    return pc.if_else(pc.is_null(text), pa.scalar(None, pa.bool_()), pc.is_in(text, value_set=pa.array(ACTIVE_VALUES)))
+
+class BatchTransform:
+    """
+    A class to transform & validate batches of one table before they are written to Snowflake.
+
+    Attributes:
+        columns (dict): Columns of the table from table_schema.json
+        as_of (date): Date used for Age & Days_Since_Consultation , By Default today
+        ETL_Batch_ID (int): ETL Run ID added to valid & error rows , if None the column is not checked
+                            (set later e.g. by the fan out)
+        date_formats (dict): Column name & strptime format of the integer dates , By Default DATE_FORMATS
+        active_days (int): Days since consultation up to which a customer is active , By Default 30
+    Example
+        transform = BatchTransform(table_config['VACCINATION_TABLE'], ETL_Batch_ID = ETL_Batch_ID)
+        result = transform(jsonl_table(file_key, 1, lines))
+        result['valid'] , result['errors']
+    """
+    def __init__(self, columns: dict, as_of: date = None, ETL_Batch_ID: int = None, date_formats: dict = None
+                 , active_days: int = ACTIVE_DAYS):
+        self.columns = columns
+        self.rules = column_rules(columns)
+        self.as_of = as_of
+        self.ETL_Batch_ID = ETL_Batch_ID
+        self.date_formats = {**DATE_FORMATS, **(date_formats or {})}
+        self.active_days = active_days
+
+    def derive(self, data: dict, as_of: date) -> dict:
+        """
+        Function to compute Age , Days_Since_Consultation & Is_Active (only for columns of the table)
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        derived = {}
+        if 'Age' in self.rules and 'DOB' in data:
+            derived['Age'] = age_in_years(data['DOB'], as_of)
+        if 'Days_Since_Consultation' in self.rules and 'Last_Consulted_Date' in data:
+            derived['Days_Since_Consultation'] = pc.days_between(data['Last_Consulted_Date'], pa.scalar(as_of, pa.date32()))
+        if 'Is_Active' in self.rules:
+            from_days = pc.less_equal(derived['Days_Since_Consultation'], self.active_days) \
+                if 'Days_Since_Consultation' in derived else None
+            source = data.get('Is_Active')
+            if source is not None:
+                source = to_boolean(source)
+            if source is not None and from_days is not None:
+                derived['Is_Active'] = pc.coalesce(source, from_days)
+            elif source is not None or from_days is not None:
+                derived['Is_Active'] = source if source is not None else from_days
+        return derived
+
+    def __call__(self, batch) -> dict:
+        """
+        Function to transform one batch (pyarrow Table or Pandas DataFrame)
+        Output:
+            dict :- {'valid': pyarrow Table with the table columns , 'errors': pyarrow Table of failed rows (text)
+                     with Error_Reason , 'rows': rows in batch , 'error_rows': rows failed}
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        if not isinstance(batch, pa.Table):
+            batch = pa.Table.from_pandas(batch, preserve_index=False)
+        as_of = self.as_of or date.today()
+
+        # json keys are matched case insensitive (same as MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE)
+        source = {name.upper(): batch.column(position).combine_chunks() for position, name in enumerate(batch.column_names)}
+        if self.ETL_Batch_ID is not None:
+            source['ETL_BATCH_ID'] = pa.repeat(pa.scalar(self.ETL_Batch_ID, pa.int64()), batch.num_rows)
+
+        # (mask , reason) of every check , a Null mask value is not an error
+        data, checks = {}, []
+        for column, rule in self.rules.items():
+            values = source.get(column.upper())
+            if values is None:
+                continue
+            if rule['type'] == 'DATE':
+                parsed = parse_int_dates(values, self.date_formats.get(column, '%Y%m%d'))
+                checks.append((pc.and_(pc.is_valid(values), pc.is_null(parsed)), f"{column} invalid date"))
+                values = parsed
+            elif rule['length'] is not None:
+                values = pc.cast(values, pa.string())
+                checks.append((pc.fill_null(pc.greater(pc.utf8_length(values), rule['length']), False)
+                               , f"{column} longer than {rule['length']}"))
+            data[column] = values
+
+        data.update(self.derive(data, as_of))
+
+        for column, rule in self.rules.items():
+            if column.upper() == 'ETL_BATCH_ID' and self.ETL_Batch_ID is None:
+                continue
+            if rule['not_null'] and not rule['default']:
+                values = data.get(column)
+                missing = pc.is_null(values) if values is not None else pa.repeat(True, batch.num_rows)
+                checks.append((missing, f"{column} is null"))
+
+        failed = pa.repeat(False, batch.num_rows)
+        for mask, _ in checks:
+            failed = pc.or_(failed, mask)
+
+        valid = pa.table({column: values for column, values in data.items()}).filter(pc.invert(failed))
+
+        # Error rows are few , so the reason text & the text copy of the source are built only for them
+        error_source = pa.table(source).filter(failed)
+        reasons = [pc.if_else(pc.filter(mask, failed), f"{reason}; ", "") for mask, reason in checks]
+        error_data = {column: pc.cast(values, pa.string()) if column not in ('FILE_ROW_NUMBER', 'ETL_BATCH_ID') else values
+                      for column, values in zip(error_source.column_names, error_source.columns)}
+        for column in ('FILE_ROW_NUMBER', 'ETL_BATCH_ID'):
+            error_data.setdefault(column, pa.nulls(error_source.num_rows, pa.int64()))
+        error_data[ERROR_COLUMN] = pc.utf8_rtrim(pc.binary_join_element_wise(*reasons, '') if reasons
+                                                 else pa.repeat('', error_source.num_rows), characters='; ')
+        errors = pa.table(error_data)
+
+        return {'valid': valid, 'errors': errors, 'rows': batch.num_rows, 'error_rows': errors.num_rows}
@@ -1,9 +1,13 @@
-from snowflake.snowpark import Session
-import  os , json 
-from datetime import datetime, timedelta
+import  os , json , re
+import argparse
 import copy
-import time 
-import asyncio
+import tempfile
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pipeline_summary import PipelineSummary
 
 ############################################################################################################
 # Assumptions:
@@ -23,32 +27,55 @@ def refresh_stage(session,stage):
     session.sql(f"""ALTER STAGE  {stage} REFRESH""").collect();
     return None
 
-# Get the Last Timestamp of 
-def get_max_timestamp_loaded_files(session , history_table):
+# Get the Last Timestamp of Loaded Files , 18 minutes overlap is kept for files which arrive late in S3
+# (files already in the ledger are removed by list_files so overlap never loads a file twice
+#  & FAILED / MISMATCHED files older than the watermark are listed again from the ledger)
+# If table is given only the files of that Staging table are used , so a table which is behind keeps its own watermark
+def get_max_timestamp_loaded_files(session , history_table , table = None):
     try:
+        table_filter = "" if table is None else """ and "TABLE" = '{}' """.format(str(table).replace("'", "''"))
         lt_modified = session.sql(f"""Select case when max(AWS_LT_MODIFIED) is Null 
                                     then '1970-01-01 05:30:00'::TIMESTAMP_LTZ 
                                 else DATEADD(minute , -18 , max(AWS_LT_MODIFIED)) end as max_lt_modified_timestamp
                                 FROM {history_table}
-                        WHERE   IS_PROCESSED = True  """).collect()
+                        WHERE   IS_PROCESSED = True {table_filter} """).collect()
         
-        return  lt_modified
+        return  lt_modified[0][0]
     except Exception as e:
         print("Error in Function filter_condition_existing_files")
         raise e
     
 
 # List all the S3 Files where Last Modified Date is greater than Loaded Files
-def list_files(session,stage,lt_modified ):  
+def list_files(session,stage,lt_modified , history_table = None , folder = None):  
     """
-    A Function to List S3 Files 
+    A Function to List S3 Files
+    If history_table (File Ledger) is given , files already processed or QUARANTINED are removed with an anti join
+    & files recorded FAILED / MISMATCHED (and not loaded since) are listed again whatever their Last_Modified ,
+    ATTEMPTS is the number of times the file failed before
+    If folder is given only the files inside stage/folder/ are listed
     """
     try:
-        files = session.sql(f"""Select RELATIVE_PATH as file_name , LAST_MODIFIED, SIZE ,   
-            split(REGEXP_SUBSTR(file_name ,'\\\d{{5,}}_\\\d+',1,1  ) ,'_')[0] :: Number as unix_timestamp ,
-            split(REGEXP_SUBSTR(file_name ,'\\\d{{5,}}_\\\d+',1,1  ) ,'_')[1] :: Number as file_index
-            from Directory('{stage}')
-            where Last_Modified >= '{lt_modified}'::TIMESTAMP_LTZ
+        modified = f"Last_Modified >= '{lt_modified}'::TIMESTAMP_LTZ"
+        attempts , failed , not_processed = "" , "" , ""
+        if history_table is not None:
+            # Watermark moves past failed files when later batches are loaded , so they are picked from the ledger
+            attempts = ", coalesce(f.ATTEMPTS, 0) as attempts"
+            failed = f"""
+            left join (Select FILE_NAME, count(*) as ATTEMPTS from {history_table}
+                       where STATUS in ('FAILED', 'MISMATCHED') group by FILE_NAME) f on f.FILE_NAME = d.RELATIVE_PATH"""
+            modified = f"({modified} or f.ATTEMPTS > 0)"
+            not_processed = f"""
+            and not exists (Select 1 from {history_table} h
+                            where h.FILE_NAME = d.RELATIVE_PATH and (h.IS_PROCESSED = True or h.STATUS = 'QUARANTINED'))"""
+        if folder:
+            not_processed += f"""
+            and startswith(d.RELATIVE_PATH , '{folder}/')"""
+        files = session.sql(f"""Select d.RELATIVE_PATH as file_name , d.LAST_MODIFIED, d.SIZE ,
+            split(REGEXP_SUBSTR(d.RELATIVE_PATH ,'\\\\d{{5,}}_\\\\d+',1,1  ) ,'_')[0] :: Number as unix_timestamp ,
+            split(REGEXP_SUBSTR(d.RELATIVE_PATH ,'\\\\d{{5,}}_\\\\d+',1,1  ) ,'_')[1] :: Number as file_index {attempts}
+            from Directory('{stage}') d {failed}
+            where {modified} {not_processed}
         ;""").collect()
         
         lt_modified_files = [file.as_dict() for file in files]
@@ -58,6 +85,68 @@ def list_files(session,stage,lt_modified ):
         print("Error in List Files Function ")
         raise e   
      
+# File Ledger :- Every file loaded into Staging table is recorded in history table with ETL_Batch_ID & Status
+def ledger_table_creation(history_table: str) -> str:
+    return f"""CREATE TABLE IF NOT EXISTS {history_table} (
+                    FILE_NAME TEXT(450) NOT NULL, FILE_SIZE NUMBER(20,0), AWS_LT_MODIFIED TIMESTAMP_LTZ,
+                    UNIX_TIMESTAMP NUMBER(20,0), FILE_INDEX NUMBER(10,0), "TABLE" TEXT(255),
+                    ETL_BATCH_ID NUMBER(15,0) NOT NULL, STATUS TEXT(20) NOT NULL, IS_PROCESSED BOOLEAN NOT NULL,
+                    RECORDED_AT TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP());"""
+
+# Record the files of a batch in File Ledger with one statement
+def record_files_statement(history_table: str, files: list, table: str, ETL_Batch_ID: int, status: str) -> str:
+    """
+    Function to create the Insert statement of File Ledger
+
+    Attributes:
+        history_table (str) :- File Ledger e.g. 'S3_FILES'
+        files (list) :- Output of list_files (FILE_NAME, SIZE, LAST_MODIFIED, UNIX_TIMESTAMP, FILE_INDEX)
+        table (str) :- Staging table the files are loaded into
+        ETL_Batch_ID (int) :- ETL Run ID
+        status (str) :- 'LOADED' (IS_PROCESSED = True) , 'FAILED' , 'MISMATCHED' or 'QUARANTINED' (not listed again)
+    Output:
+        str :- INSERT statement
+    """
+    def value(data):
+        if data is None:
+            return "NULL"
+        return "'{}'".format(str(data).replace("'", "''"))
+
+    is_processed = 'TRUE' if status == 'LOADED' else 'FALSE'
+    rows = ",\n".join(f"({value(file['FILE_NAME'])}, {value(file.get('SIZE'))}, {value(file.get('LAST_MODIFIED'))}::TIMESTAMP_LTZ"
+                      f", {value(file.get('UNIX_TIMESTAMP'))}, {value(file.get('FILE_INDEX'))}, {value(table)}"
+                      f", {ETL_Batch_ID}, {value(status)}, {is_processed})"
+                      for file in files)
+
+    return f"""Insert into {history_table} (FILE_NAME, FILE_SIZE, AWS_LT_MODIFIED, UNIX_TIMESTAMP, FILE_INDEX, "TABLE"
+                                            , ETL_BATCH_ID, STATUS, IS_PROCESSED)
+                Values {rows};"""
+
+# One File Ledger insert per batch_size files (a single VALUES list for a whole run would hit the
+# expression & statement size limits of Snowflake) , By Default the COPY batch size
+def record_files_statements(history_table: str, files: list, table: str, ETL_Batch_ID: int, status: str
+                            , batch_size: int = None) -> list:
+    batch_size = batch_size or MAX_FILES_PER_COPY
+    return [record_files_statement(history_table, files[start:start + batch_size], table, ETL_Batch_ID, status)
+            for start in range(0, len(files), batch_size)]
+
+# Files which failed (COPY error / reconciliation) are recorded FAILED or MISMATCHED , a file failing for
+# the max_attempts time is recorded QUARANTINED & is not listed again (its ledger rows are deleted to retry it)
+def record_failed_files_statements(history_table: str, files: list, table: str, ETL_Batch_ID: int, status: str
+                                   , max_attempts: int = 3) -> dict:
+    """
+    Output:
+        dict :- {'statements': File Ledger inserts , 'quarantined': file names recorded QUARANTINED}
+    """
+    def last_attempt(file):
+        return bool(max_attempts) and (file.get('ATTEMPTS') or 0) + 1 >= max_attempts
+
+    quarantined = [file for file in files if last_attempt(file)]
+    retried = [file for file in files if not last_attempt(file)]
+    return {'statements': record_files_statements(history_table, retried, table, ETL_Batch_ID, status)
+                          + record_files_statements(history_table, quarantined, table, ETL_Batch_ID, 'QUARANTINED')
+            , 'quarantined': [file['FILE_NAME'] for file in quarantined]}
+
 # Asuming Table is already created in Snowflake , if needed we can generate DDL From JSON Schema
 def table_creation(schema: dict , database: str) -> list:
         """
@@ -85,9 +174,74 @@ def table_creation(schema: dict , database: str) -> list:
 
         return create_temp_tables_sql
 
+# Table name for the Country specific target table e.g. vaccination_data_IND
+def country_table_name(table: str, country: str) -> str:
+    return f"{table}_{re.sub(r'[^0-9A-Za-z]', '_', str(country)).upper()}"
+
+# Create the Country Tables from JSON Schema , new countries get their table on the first load
+def country_table_creation(columns: dict, database: str, table: str, countries: list) -> dict:
+    """
+    Function to create the DDL of Country Tables
+
+    Attributes:
+        columns (dict) :- Column name & Data Type from table_schema.json
+        database (str) :- Database/Schema prefix of the target tables e.g. 'PRD.'
+        table (str) :- Base target table name e.g. 'vaccination_data'
+        countries (list) :- Countries present in the staging table
+    Output:
+        dict :- key as country & value as CREATE TABLE IF NOT EXISTS statement
+    """
+    column_sql = ", ".join([f"{column} {data_type}" for column, data_type in columns.items()])
+
+    return {country: f"CREATE TABLE IF NOT EXISTS {database}{country_table_name(table, country)} ({column_sql});"
+            for country in countries}
+
+# Query of the tables which already exist , so DDL is sent only for the missing ones
+# database is the prefix of the tables e.g. 'PRD.' (schema of the current database) or 'DB.PRD.'
+def existing_tables_statement(database: str, tables: list) -> str:
+    parts = [part for part in database.split('.') if part]
+    information_schema = f"{parts[0]}.INFORMATION_SCHEMA.TABLES" if len(parts) > 1 else "INFORMATION_SCHEMA.TABLES"
+    schema = f"'{parts[-1].upper()}'" if parts else "CURRENT_SCHEMA()"
+    table_list = ", ".join("'{}'".format(table.upper().replace("'", "''")) for table in tables)
+    return f"""Select TABLE_NAME from {information_schema}
+                where TABLE_SCHEMA = {schema} and TABLE_NAME in ({table_list});"""
+
+# Route all the Staging rows to Country / Default / Error tables in one statement (single scan of staging table)
+def fan_out_statement(columns: list, source_table: str, target_table: str, countries: list
+                      , error_table: str, overrides: dict = None) -> str:
+    """
+    Function to create multi-table INSERT FIRST statement
+
+    Attributes:
+        columns (list) :- Columns of the target tables (keys of table_schema.json table)
+        source_table (str) :- Staging table e.g. 'STG.TEMP_stg_vacination'
+        target_table (str) :- Fully qualified base target table , Country tables are target_table_<COUNTRY>
+                              & rows of a country without a branch goes to target_table itself
+        countries (list) :- Countries which get their own branch
+        error_table (str) :- Fully qualified table for rows where COUNTRY is Null
+        overrides (dict) :- Column name & SQL expression used instead of the staging column e.g. {'ETL_Batch_ID': 1711917526}
+    Output:
+        str :- INSERT FIRST statement
+    """
+    overrides = {column.upper(): expression for column, expression in (overrides or {}).items()}
+
+    column_list = ", ".join(columns)
+    select_list = ", ".join([f"{overrides[column.upper()]} as {column}" if column.upper() in overrides else column
+                             for column in columns])
+    into = f"({column_list}) VALUES ({column_list})"
+
+    branches = [f"WHEN COUNTRY IS NULL THEN INTO {error_table} {into}"]
+    for country in countries:
+        country_value = str(country).replace("'", "''")
+        branches.append(f"WHEN COUNTRY = '{country_value}' THEN INTO {country_table_name(target_table, country)} {into}")
+    branches.append(f"ELSE INTO {target_table} {into}")
+
+    return "INSERT FIRST\n    " + "\n    ".join(branches) + f"\nSELECT {select_list} FROM {source_table};"
+
 # Function to Load the Files into Snowflake Staged Table
-def copy_into_statement(table:str, files:list, database:str,stage: str) -> str:
+def copy_into_statement(table:str, files:list, database:str,stage: str , force: bool = False) -> str:
     # For Nested Json
+    # force loads files again even if COPY load metadata says they are loaded (files retried after MISMATCHED)
 
     if len(files) == 1:
         files = f"('{files[0]}')"
@@ -98,30 +252,556 @@ def copy_into_statement(table:str, files:list, database:str,stage: str) -> str:
                         FILES = {files}
                          MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
                         INCLUDE_METADATA = (File_Source = METADATA$FILENAME , FILE_ROW_NUMBER= METADATA$FILE_ROW_NUMBER)
-                        ON_ERROR=ABORT_STATEMENT; """.format(table=table, files=files
-                                                             ,database=database , stage = stage )
-connection_parameters = {
-            "user":  'xxxx.com',
-            "password": 'sf_password',
-            "account":  'sf_account',
-            "warehouse":  'TRANSFORM_WH',
-            "database" : "vacination_data",
-            "schema" : 'sf_schema'
-        }
-print(f"Connection for {'sf_account'} ")
-session = Session.builder.configs(connection_parameters).create()
+                        ON_ERROR=ABORT_STATEMENT{force}; """.format(table=table, files=files
+                                                             ,database=database , stage = stage
+                                                             , force = " FORCE = TRUE" if force else "")
 
+# Load threads per Virtual Warehouse size
 # # # # # #  # # # #
 # XS -     8       #
 # S -      16      # 
 # M -      32      #
 # L -      64      #
 # XL -     128     #  
-# 2X-Large 256     #     
+# 2XL -    256     #
 # # # # # # # # # # 
+WAREHOUSE_THREADS = {'XS': 8, 'S': 16, 'M': 32, 'L': 64, 'XL': 128, '2XL': 256}
+
+# Snowflake allows at most 1000 files in the FILES clause of a COPY statement
+MAX_FILES_PER_COPY = 1000
+
+# Split the Files into COPY batches by total bytes & file count
+def plan_copy_batches(files: list, warehouse_size: str = 'XS', bytes_per_thread: int = 256 * 1024 * 1024
+                      , max_files: int = MAX_FILES_PER_COPY) -> list:
+    """
+    Function to bin-pack the listed files into COPY batches so each batch keeps every load thread of the warehouse busy
+
+    Attributes:
+        files (list) :- Output of list_files (FILE_NAME, SIZE, UNIX_TIMESTAMP, FILE_INDEX)
+        warehouse_size (str) :- XS / S / M / L / XL / 2XL
+        bytes_per_thread (int) :- Bytes one load thread should get in a batch , By Default 256 MB
+        max_files (int) :- Maximum number of files in one batch , By Default 1000
+    Output:
+        list :- list of batches (list of files) in (unix_timestamp, file_index) order
+                , files without <unix_timestamp>_<file_index> in the name (e.g. _SUCCESS / manifest) are reported & skipped
+                , files which failed before (ATTEMPTS > 0) get a batch of their own so a bad file fails alone
+    """
+    threads = WAREHOUSE_THREADS[warehouse_size.upper()]
+    max_bytes = threads * bytes_per_thread
+    max_files = max(1, min(max_files, MAX_FILES_PER_COPY))
+
+    unmatched = [file['FILE_NAME'] for file in files if file.get('UNIX_TIMESTAMP') is None or file.get('FILE_INDEX') is None]
+    if unmatched:
+        print(f"Skipped {len(unmatched)} files not matching <unix_timestamp>_<file_index> : {unmatched[:10]}")
+        files = [file for file in files if file.get('UNIX_TIMESTAMP') is not None and file.get('FILE_INDEX') is not None]
+
+    # Batches are filled in order so the watermark of a loaded batch is always behind the next one
+    files = sorted(files, key=lambda item: (item['UNIX_TIMESTAMP'], item['FILE_INDEX']))
+
+    batches = []
+    batch, batch_bytes = [], 0
+    for file in files:
+        size = file.get('SIZE') or 0
+        if batch and (len(batch) >= max_files or batch_bytes + size > max_bytes or file.get('ATTEMPTS')):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        if file.get('ATTEMPTS'):
+            batches.append([file])
+            continue
+        batch.append(file)
+        batch_bytes += size
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+# Submit the Statements without blocking & poll them , at most max_in_flight queries run at the same time
+def execute_async(session, statements: list, max_in_flight: int = 4, poll_interval: float = 0.5) -> dict:
+    """
+    Function to execute statements concurrently in Snowflake using non blocking query submission (collect_nowait)
+
+    Attributes:
+        session :- Snowpark Session
+        statements (list) :- SQL Statements e.g. one copy_into_statement per batch of files
+        max_in_flight (int) :- Maximum number of queries submitted & not yet finished
+        poll_interval (float) :- Seconds to wait before polling the running queries again
+    Output:
+        dict :- {'results' : {batch_no : rows}, 'failures' : {batch_no : exception}, 'query_ids' : {batch_no : query_id}
+                 , 'elapsed' : {batch_no : seconds from submit until found finished}}
+    """
+    pending = deque(enumerate(statements))
+    running = {}
+    results, failures, query_ids, elapsed, submitted = {}, {}, {}, {}, {}
+
+    while pending or running:
+
+        while pending and len(running) < max_in_flight:
+            batch_no, statement = pending.popleft()
+            try:
+                job = session.sql(statement).collect_nowait()
+            except Exception as e:
+                failures[batch_no] = e
+                continue
+            running[batch_no] = job
+            query_ids[batch_no] = job.query_id
+            submitted[batch_no] = time.perf_counter()
+
+        finished = [batch_no for batch_no, job in running.items() if job.is_done()]
+
+        for batch_no in finished:
+            job = running.pop(batch_no)
+            elapsed[batch_no] = time.perf_counter() - submitted[batch_no]
+            try:
+                results[batch_no] = job.result()
+            except Exception as e:
+                failures[batch_no] = e
+
+        # Nothing finished in this round , wait before polling again
+        if running and not finished:
+            time.sleep(poll_interval)
+
+    return {'results': results, 'failures': failures, 'query_ids': query_ids, 'elapsed': elapsed}
+
+# Snowflake Connection , every value can be overridden with environment variable SNOWFLAKE_<KEY> e.g. SNOWFLAKE_PASSWORD
+def get_connection_parameters() -> dict:
+    connection_parameters = {
+            "user":  'xxxx.com',
+            "password": 'sf_password',
+            "account":  'sf_account',
+            "warehouse":  'TRANSFORM_WH',
+            "database" : "vacination_data",
+            "schema" : 'sf_schema'
+        }
+    return {key: os.environ.get(f"SNOWFLAKE_{key.upper()}", value) for key, value in connection_parameters.items()}
+
+# Snowpark is imported only when a session is really needed (not for --plan)
+def create_session(connection_parameters: dict):
+    from snowflake.snowpark import Session
+
+    print(f"Connection for {connection_parameters['account']} ")
+    return Session.builder.configs(connection_parameters).create()
+
+class PlanRow(dict):
+    """
+    Row returned by PlanSession , supports as_dict() & positional access like Snowpark Row
+    """
+    def as_dict(self) -> dict:
+        return dict(self)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return super().__getitem__(key)
+
+class PlanSession:
+    """
+    A stand-in for Snowpark Session used by --plan , statements are recorded instead of executed (no connection).
+
+    Attributes:
+        files (list): File names returned by the stage listing , COPY batches are planned for these files
+                      (names without <unix_timestamp>_<file_index> get NULL like the REGEXP_SUBSTR of list_files)
+        countries (list): Countries returned by the country discovery
+    """
+    def __init__(self, files: list = None, countries: list = None):
+        self.statements = []
+        self.query_tag = None
+        self.files = []
+        for file_name in files or []:
+            matched = re.search(r'(\d{5,})_(\d+)', file_name)
+            self.files.append(PlanRow(FILE_NAME=file_name, LAST_MODIFIED=None, SIZE=0
+                                      , UNIX_TIMESTAMP=int(matched.group(1)) if matched else None
+                                      , FILE_INDEX=int(matched.group(2)) if matched else None))
+        self.countries = countries or []
+
+    def _result(self, query: str) -> list:
+        if 'from Directory(' in query:
+            return self.files
+        if 'Select distinct COUNTRY' in query:
+            return [PlanRow(COUNTRY=country) for country in self.countries]
+        if 'max(AWS_LT_MODIFIED)' in query:
+            return [PlanRow(MAX_LT_MODIFIED_TIMESTAMP='1970-01-01 05:30:00')]
+        return []
+
+    def sql(self, query: str):
+        self.statements.append(query)
+        return PlanResult(self._result(query), f"plan-{len(self.statements)}")
+
+    def query_history(self):
+        return PlanResult([], None)
+
+    def close(self):
+        pass
 
-def main(session):
-    script = 'dev'
+class PlanResult:
+    """
+    Result of PlanSession.sql , works as DataFrame (collect / collect_nowait) , AsyncJob & query_history
+    """
+    def __init__(self, rows: list, query_id: str):
+        self.rows = rows
+        self.query_id = query_id
+        self.queries = []
+
+    def collect(self) -> list:
+        return self.rows
+
+    def collect_nowait(self):
+        return self
+
+    def is_done(self) -> bool:
+        return True
+
+    def result(self) -> list:
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+# Statements inside the block are committed together or rolled back on any exception
+@contextmanager
+def transaction(session):
+    session.sql("begin;").collect()
+    try:
+        yield session
+    except BaseException:
+        session.sql("rollback;").collect()
+        raise
+    session.sql("commit;").collect()
+
+# Sum of the numeric columns of COPY (rows_loaded) / INSERT (number of rows inserted) results
+def rows_affected(rows: list, column: str = None) -> int:
+    total = 0
+    for row in rows or []:
+        row = row.as_dict() if hasattr(row, 'as_dict') else dict(row)
+        values = [row.get(column)] if column else row.values()
+        total += sum(value for value in values if isinstance(value, int) and not isinstance(value, bool))
+    return total
+
+# Staging / Target / Error table names of a table of table_schema.json
+# e.g. "tables" : {"VACCINATION_TABLE" : {"staging_table" : "stg_vacination", "target_table" : "vaccination_data"}}
+def table_names(script_parameters: dict, table: str) -> dict:
+    table_parameters = script_parameters.get('tables', {}).get(table, {})
+    staging = table_parameters.get('staging_table', table.lower())
+    target = table_parameters.get('target_table', table.lower())
+    return {'staging': staging, 'target': target, 'error': table_parameters.get('error_table', f"{target}_error")}
+
+#Step No 1 ;- Refresh Stage & create File Ledger (once per stage)
+def refresh_step(session, summary, script_parameters: dict):
+    with summary.step('refresh_stage', session = session):
+        refresh_stage(session, script_parameters['stage'])
+        session.sql(ledger_table_creation(script_parameters['history_table'])).collect()
+
+#step No 2 & 3 :- List the files which are greater than Last Timestamp & not in File Ledger
+def list_step(session, summary, script_parameters: dict, staging: str) -> list:
+    history_table = script_parameters['history_table']
+
+    with summary.step('watermark', session = session) as step:
+        lt_timestamp = get_max_timestamp_loaded_files(session , history_table , table = staging)
+        step['details']['lt_modified'] = str(lt_timestamp)
+
+    with summary.step('list_files', session = session) as step:
+        files_to_load = list_files(session, script_parameters['stage'], lt_timestamp
+                                   , history_table = history_table, folder = staging)
+        step['files'] = len(files_to_load)
+        step['bytes_loaded'] = sum(file.get('SIZE') or 0 for file in files_to_load)
+
+    return files_to_load
+
+#step No 4 (optional) ;- Transcode the listed JSON files into Parquet & upload them to a temporary stage
+def transcode_step(session, summary, script_parameters: dict, copy_batches: list, columns: dict, staging: str) -> dict:
+    """
+    Function to transcode the files of every COPY batch into Parquet (see transcode.py)
+    "transcode" : {"enabled" : true, "bucket" : "<bucket of the stage>", "prefix" : "<S3 path of the stage>/"
+                   , "compression" : "zstd", "workers" : null, "upload_threads" : 4 , "json_bytes_per_second" : null}
+    json_bytes_per_second is the JSON COPY speed seen before (BYTES_LOADED / ELAPSED_SECONDS of copy step in
+    PIPELINE_SUMMARY) , if given the time saved per batch is estimated from it
+    Output:
+        dict :- {'stage': temporary stage , 'statements': Parquet COPY per batch (None when a file of the batch
+                 could not be transcoded , JSON COPY is used for it) , 'batches': bytes & seconds per batch}
+    """
+    from common import s3_client
+    from transcode import parquet_copy_statement, transcode_files
+
+    transcode = script_parameters['transcode']
+    temp_schema = script_parameters['temp_schema']
+    stage = f"{temp_schema}TRANSCODE_{staging}_{uuid.uuid4().hex[:12]}"
+
+    with summary.step('transcode', session = session) as step:
+        s3 = s3_client(transcode['bucket'], os.environ.get('AWS_ACCESS_KEY_ID'), os.environ.get('AWS_SECRET_ACCESS_KEY')
+                       , transcode.get('region', 'eu-west-1'))
+        session.sql(f"CREATE TEMPORARY STAGE IF NOT EXISTS {stage}").collect()
+
+        with tempfile.TemporaryDirectory() as directory:
+            results = transcode_files(s3, [file for batch in copy_batches for file in batch], columns, directory
+                                      , prefix = transcode.get('prefix', ''), compression = transcode.get('compression', 'zstd')
+                                      , max_workers = transcode.get('workers'))
+
+            def upload(path):
+                session.file.put(f"file://{path}", f"@{stage}", auto_compress=False, overwrite=True)
+
+            with ThreadPoolExecutor(max_workers = transcode.get('upload_threads', 4)) as executor:
+                futures = {file_name: executor.submit(upload, result['path']) for file_name, result in results.items()
+                           if not isinstance(result, Exception)}
+                for file_name, future in futures.items():
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Upload of {file_name} failed : {e}")
+                        results[file_name] = e
+
+        statements, batches = [], []
+        for batch in copy_batches:
+            transcoded = [results[file['FILE_NAME']] for file in batch]
+            if any(isinstance(result, Exception) for result in transcoded):
+                statements.append(None)
+                batches.append({'format': 'JSON', 'files': len(batch)})
+                continue
+            statements.append(parquet_copy_statement(staging, [os.path.basename(result['path']) for result in transcoded]
+                                                     , temp_schema, stage))
+            json_bytes = sum(result['json_bytes'] for result in transcoded)
+            parquet_bytes = sum(result['parquet_bytes'] for result in transcoded)
+            batches.append({'format': 'PARQUET', 'files': len(batch), 'rows': sum(result['rows'] for result in transcoded)
+                            , 'json_bytes': json_bytes, 'parquet_bytes': parquet_bytes, 'bytes_saved': json_bytes - parquet_bytes
+                            , 'transcode_seconds': round(sum(result['seconds'] for result in transcoded), 3)})
+
+        step['files'] = sum(batch['files'] for batch in batches if batch['format'] == 'PARQUET')
+        step['bytes_loaded'] = sum(batch['parquet_bytes'] for batch in batches if batch['format'] == 'PARQUET')
+        step['details']['failed_files'] = {file_name: str(result) for file_name, result in results.items()
+                                           if isinstance(result, Exception)}
+
+    return {'stage': stage, 'statements': statements, 'batches': batches}
+
+#step No 4 ;- Load files into Staging Table , one COPY statement per batch of files
+def copy_step(session, summary, script_parameters: dict, ETL_Batch_ID: int, files_to_load: list, staging: str
+              , columns: dict = None) -> dict:
+    """
+    Function to COPY the files into Staging table & record failed files in File Ledger
+    Files are transcoded into Parquet first when "transcode" is enabled (columns of table_schema.json are needed)
+    Output:
+        dict :- output of execute_async with 'loaded_files' & 'failed_files'
+    """
+    temp_schema = script_parameters['temp_schema']
+    history_table = script_parameters['history_table']
+
+    copy_batches = plan_copy_batches(files_to_load, warehouse_size = script_parameters.get('warehouse_size', 'XS'))
+    # FILES are relative to the table folder of the stage
+    load_statements = [copy_into_statement(table = staging
+                                           , files = [file['FILE_NAME'][len(staging) + 1:] if file['FILE_NAME'].startswith(f"{staging}/")
+                                                      else file['FILE_NAME'] for file in batch]
+                                           , database = temp_schema, stage = script_parameters['stage']
+                                           , force = any(file.get('ATTEMPTS') for file in batch))
+                       for batch in copy_batches]
+
+    transcoded = None
+    if (script_parameters.get('transcode') or {}).get('enabled') and columns:
+        transcoded = transcode_step(session, summary, script_parameters, copy_batches, columns, staging)
+        load_statements = [parquet_statement or json_statement
+                           for parquet_statement, json_statement in zip(transcoded['statements'], load_statements)]
+
+    with summary.step('copy', session = session) as step:
+        # Staging table only keeps the files of this ETL run
+        session.sql(f"TRUNCATE TABLE IF EXISTS {temp_schema}TEMP_{staging}").collect()
+
+        try:
+            if script_parameters.get('async'):
+                load_summary = execute_async(session, load_statements
+                                             , max_in_flight = script_parameters.get('max_concurrent_copies', 4))
+            else:
+                load_summary = {'results': {}, 'failures': {}, 'query_ids': {}, 'elapsed': {}}
+                for batch_no, load_statement in enumerate(load_statements):
+                    start_time = time.perf_counter()
+                    try:
+                        load_summary['results'][batch_no] = session.sql(load_statement).collect()
+                    except Exception as e:
+                        load_summary['failures'][batch_no] = e
+                    load_summary['elapsed'][batch_no] = time.perf_counter() - start_time
+        finally:
+            if transcoded:
+                session.sql(f"DROP STAGE IF EXISTS {transcoded['stage']}").collect()
+
+        load_summary['loaded_files'] = [file for batch_no in sorted(load_summary['results']) for file in copy_batches[batch_no]]
+        load_summary['failed_files'] = [file for batch_no in sorted(load_summary['failures']) for file in copy_batches[batch_no]]
+
+        step['files'] = len(load_summary['loaded_files'])
+        step['bytes_loaded'] = sum(file.get('SIZE') or 0 for file in load_summary['loaded_files'])
+        step['rows_loaded'] = sum(rows_affected(rows, 'rows_loaded') for rows in load_summary['results'].values())
+        step['query_ids'].extend(query_id for query_id in load_summary['query_ids'].values() if query_id not in step['query_ids'])
+        step['details']['files_per_batch'] = [len(batch) for batch in copy_batches]
+        step['details']['failed_batches'] = {batch_no: str(e) for batch_no, e in load_summary['failures'].items()}
+
+        if transcoded:
+            json_bytes_per_second = script_parameters['transcode'].get('json_bytes_per_second')
+            workers = script_parameters['transcode'].get('workers') or os.cpu_count() or 1
+            for batch_no, batch in enumerate(transcoded['batches']):
+                batch['copy_seconds'] = round(load_summary['elapsed'].get(batch_no, 0.0), 3)
+                if json_bytes_per_second and batch['format'] == 'PARQUET':
+                    # Estimated JSON COPY time - (Parquet COPY time + transcode time spread over the workers)
+                    json_copy_seconds = batch['json_bytes'] / json_bytes_per_second
+                    batch['time_saved_seconds'] = round(json_copy_seconds - batch['copy_seconds']
+                                                        - batch['transcode_seconds'] / workers, 3)
+            step['details']['transcode'] = transcoded['batches']
+
+        # One ledger insert per failed COPY batch (& one for its files failing for the last time)
+        quarantined = []
+        for batch_no in sorted(load_summary['failures']):
+            failed = record_failed_files_statements(history_table, copy_batches[batch_no], staging, ETL_Batch_ID, 'FAILED'
+                                                    , script_parameters.get('max_file_attempts', 3))
+            for statement in failed['statements']:
+                session.sql(statement).collect()
+            quarantined.extend(failed['quarantined'])
+        if quarantined:
+            print(f"Quarantined {len(quarantined)} files after {script_parameters.get('max_file_attempts', 3)} failed attempts : {quarantined[:10]}")
+        step['details']['quarantined_files'] = quarantined
+
+    return load_summary
+
+#step No 5 , 6 & 7 :- Load the Data into Country / Error Tables & mark the files processed in File Ledger
+def fan_out_step(session, summary, script_parameters: dict, ETL_Batch_ID: int, columns: dict
+                 , names: dict, loaded_files: list, replace: bool = False):
+    """
+    Function to load the Staging table into Country / Error tables , reconcile & record the files in File Ledger
+    replace True first removes what an earlier attempt of this ETL_Batch_ID loaded for the files (used on retry
+    so a fan out which was committed but reported as failed is not loaded twice)
+    Output:
+        dict :- {'mismatched_files': output of reconcile_step}
+    """
+    temp_schema = script_parameters['temp_schema']
+    target_database = script_parameters['target_database']
+    staging_table = f"{temp_schema}TEMP_{names['staging']}"
+    target_table = f"{target_database}{names['target']}"
+    error_table = f"{target_database}{names['error']}"
+    column_sql = ", ".join([f"{column} {data_type}" for column, data_type in columns.items()])
+
+    # step No 5 ;- Get the List of Country in Staging Files
+    with summary.step('country_discovery', session = session) as step:
+        if 'COUNTRY' in (column.upper() for column in columns):
+            country_list = session.sql(f"""Select distinct COUNTRY from {staging_table} where COUNTRY is not null""").collect()
+            countries = [country.as_dict()['COUNTRY'] for country in country_list]
+        else:
+            countries = None
+        step['details']['countries'] = countries
+
+        # New Countries & Error table are created from JSON Schema , one query finds the tables which exist
+        ddl = {country_table_name(names['target'], country): statement for country, statement
+               in country_table_creation(columns, target_database, names['target'], countries or []).items()}
+        base_table = names['error'] if countries is not None else names['target']
+        ddl[base_table] = f"CREATE TABLE IF NOT EXISTS {target_database}{base_table} ({column_sql});"
+        existing = {row.as_dict()['TABLE_NAME'].upper() for row
+                    in session.sql(existing_tables_statement(target_database, list(ddl))).collect()}
+        for table, statement in ddl.items():
+            if table.upper() not in existing:
+                session.sql(statement).collect()
+        step['details']['created_tables'] = [table for table in ddl if table.upper() not in existing]
+
+    # Fan out , reconcile & File Ledger are committed together , a run which dies in between leaves nothing
+    # in the target tables & the files are listed again (DDL above commits implicitly so it stays outside ,
+    # steps inside do not change the QUERY_TAG so no ALTER SESSION is sent in the transaction)
+    session.query_tag = json.dumps({'ETL_Batch_ID': ETL_Batch_ID, 'pipeline': summary.pipeline, 'step': 'fan_out'})
+    target_tables = [target_table] + [f"{target_database}{country_table_name(names['target'], country)}"
+                                      for country in countries or []]
+    with transaction(session):
+        if replace:
+            from reconciliation import delete_files_statements
+
+            with summary.step('clear_batch', session = session, tag = False) as step:
+                file_names = [file['FILE_NAME'] for file in loaded_files]
+                for statement in delete_files_statements(target_tables + ([error_table] if countries is not None else [])
+                                                         , ETL_Batch_ID, file_names):
+                    step['rows_loaded'] += rows_affected(session.sql(statement).collect())
+                # Ledger rows the earlier attempt wrote for the files (LOADED / MISMATCHED / QUARANTINED)
+                for statement in delete_files_statements([script_parameters['history_table']], ETL_Batch_ID, file_names
+                                                         , column = 'FILE_NAME'):
+                    session.sql(statement).collect()
+                step['files'] = len(file_names)
+
+        # step No 6 :- Load the Data into Country / Error Tables with a single scan of Staging Table
+        with summary.step('fan_out', session = session, tag = False) as step:
+            if countries is not None:
+                statement = fan_out_statement(list(columns), staging_table, target_table, countries, error_table
+                                              , overrides = {'ETL_Batch_ID': ETL_Batch_ID})
+            else:
+                # Tables without Country are loaded as is
+                select_list = ", ".join(f"{ETL_Batch_ID} as {column}" if column.upper() == 'ETL_BATCH_ID' else column for column in columns)
+                statement = f"Insert into {target_table} ({', '.join(columns)}) Select {select_list} from {staging_table};"
+            step['rows_loaded'] = rows_affected(session.sql(statement).collect())
+
+        # step No 6.1 :- Staging & Target / Error tables are compared per file , mismatched files are loaded again
+        mismatches = {}
+        if script_parameters.get('reconcile', True):
+            mismatches = reconcile_step(session, summary, script_parameters, ETL_Batch_ID, columns, names['staging']
+                                        , target_tables, error_table if countries is not None else None, loaded_files)
+            loaded_files = [file for file in loaded_files if file['FILE_NAME'] not in mismatches]
+
+        # step No 7 :- Files are marked processed only after they reached the target tables
+        with summary.step('record_files', session = session, tag = False) as step:
+            for statement in record_files_statements(script_parameters['history_table'], loaded_files, names['staging']
+                                                     , ETL_Batch_ID, 'LOADED'):
+                session.sql(statement).collect()
+            step['files'] = len(loaded_files)
+
+    return {'mismatched_files': mismatches}
+
+#step No 6.1 :- Counts & checksums per File_Source of Staging vs Target + Error tables (see reconciliation.py)
+def reconcile_step(session, summary, script_parameters: dict, ETL_Batch_ID: int, columns: dict, staging: str
+                   , target_tables: list, error_table: str, loaded_files: list) -> dict:
+    """
+    Function to reconcile the fan out , rows of mismatched files are deleted from the target tables
+    & the files are recorded MISMATCHED in File Ledger so the next run loads them again
+    (loaded files without any Staging row are mismatched too , QUARANTINED after max_file_attempts)
+    Output:
+        dict :- output of mismatched_files (empty when everything matched)
+    """
+    from reconciliation import (delete_files_statements, mismatched_files, reconciliation_statement
+                                , staged_files_statement, unstaged_files)
+
+    staging_table = f"{script_parameters['temp_schema']}TEMP_{staging}"
+
+    with summary.step('reconcile', session = session, tag = False) as step:
+        mismatches = mismatched_files(session.sql(reconciliation_statement(columns, staging_table, target_tables
+                                                                           , error_table, ETL_Batch_ID)).collect())
+        mismatches.update(unstaged_files(loaded_files, session.sql(staged_files_statement(staging_table)).collect()))
+        step['files'] = len(loaded_files)
+        step['details']['mismatched_files'] = mismatches
+
+        if mismatches:
+            print(f"Reconciliation failed for {len(mismatches)} files : {sorted(mismatches)}")
+            for statement in delete_files_statements(target_tables + ([error_table] if error_table else [])
+                                                     , ETL_Batch_ID, list(mismatches)):
+                session.sql(statement).collect()
+            failed = record_failed_files_statements(script_parameters['history_table']
+                                                    , [file for file in loaded_files if file['FILE_NAME'] in mismatches]
+                                                    , staging, ETL_Batch_ID, 'MISMATCHED'
+                                                    , script_parameters.get('max_file_attempts', 3))
+            for statement in failed['statements']:
+                session.sql(statement).collect()
+            step['details']['quarantined_files'] = failed['quarantined']
+
+    return mismatches
+
+# Step No 1 to 7 of the pipeline for one table , every step is timed in PipelineSummary
+def run_steps(session, summary, script_parameters: dict, ETL_Batch_ID: int, table: str, columns: dict) -> dict:
+    names = table_names(script_parameters, table)
+
+    refresh_step(session, summary, script_parameters)
+
+    files_to_load = list_step(session, summary, script_parameters, names['staging'])
+
+    if not files_to_load:
+        print(f"No new files to load for {table}")
+        return None
+
+    load_summary = copy_step(session, summary, script_parameters, ETL_Batch_ID, files_to_load, names['staging'], columns)
+
+    if load_summary['loaded_files']:
+        load_summary.update(fan_out_step(session, summary, script_parameters, ETL_Batch_ID, columns, names
+                                         , load_summary['loaded_files']))
+
+    return load_summary
+
+def main(session, script: str = 'dev'):
     try:
         ETL_Batch_ID = int(time.time())
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -130,43 +810,27 @@ def main(session):
         table_schema = script_parameters['table_schema']
 
         # Load Script Parameters
-        stage = script_parameters['stage'] 
-        temp_schema = script_parameters['temp_schema']
-        target_database = script_parameters['target_database']
-        history_table = script_parameters['history_table']
         schema_path = os.path.join(script_dir, table_schema)
         table_config = load_json_file(schema_path)  
 
-        #Step No 1 ;- Refresh Stage
-        refresh_stage(session,stage)
-
-        #step No 2 :- Get the Last Timestamp of Loaded Files
-        lt_timestamp = get_max_timestamp_loaded_files(session , history_table)
-
-        #step No 3 :- List the files  which are greater than Last Timestamp
+        summary = PipelineSummary(ETL_Batch_ID, f"vaccination_data_pipeline.{script}", session)
 
-        files_to_load = list_files(session,stage,lt_timestamp )
+        try:
+            load_summary = run_steps(session, summary, script_parameters, ETL_Batch_ID
+                                     , 'VACCINATION_TABLE', table_config['VACCINATION_TABLE'])
+        finally:
+            # Summary is written even if a step failed so the failed step can be found ,
+            # an error while writing it is only printed so the error of the step is raised
+            try:
+                summary.flush(session = session, table = script_parameters.get('pipeline_summary')
+                              , path = script_parameters.get('summary_path'))
+            except Exception as e:
+                print(f"Error writing Pipeline Summary : {e}")
 
-        # In Production we can use Async Pipeline & Chunk of Files to load in Database
-
-        #step No 4 ;- Load files into Staging Table
-
-        load_statement = copy_into_statement(table = 'stg_vacination', files = files_to_load
-                                             , database = temp_schema,stage = stage)
-        # In production I will also pass the BATCH ID for ETL Run so that we can track the data
-        session.sql(load_statement).collect()
-
-        # step No 5 ;- Get the List of Country in Staging Files
-
-        country_list = session.sql(f"""Select distinct COUNTRY from {temp_schema}stg_vacination""").collect()
-
-        # step No 6 :- Load the Data into target Table with country as Distinct country as filter
-        
-        for country in country_list:
-            country = country.as_dict()['COUNTRY']
-            session.sql(f"""Insert into {target_database}vaccination_data ({','.join(table_config.keys())} )
-                            Select ({','.join(table_config.keys())} )
-                              from {temp_schema}stg_vacination where COUNTRY = '{country}' """).collect()
+        if load_summary and load_summary['failures']:
+            raise RuntimeError(f"COPY failed for batches {sorted(load_summary['failures'])} : {load_summary['failures']}")
+        if load_summary and load_summary.get('mismatched_files'):
+            raise RuntimeError(f"Reconciliation failed for files {sorted(load_summary['mismatched_files'])}")
 
     # For derived Columns 
     # I will create a view in Snowflake & asks end user to query the view as age , 
@@ -174,11 +838,44 @@ def main(session):
 
 
     # Validations can be added to check the data in target table
-    # 1. Rows Loaded in stg table should be equal to all the rows loaded in target table
-    # 2. In case of any Null in Country List Load that data in error_data with ETL_PIPE_ID & Filename , Integrate with Slack / Teams for 
+    # 1. Rows Loaded in stg table should be equal to all the rows loaded in target table (reconcile_step)
+    # 2. In case of any Null in Country List Load that data in error_data with ETL_PIPE_ID & Filename (reconcile_step) , Integrate with Slack / Teams for 
     #     real time notification
     # 3. Create a Log Table for any error in Data Pipeline 
 
     except Exception as e:
         print("Error in Main Function ")
-        raise e
\ No newline at end of file
+        raise e
+
+def cli(argv: list = None):
+    """
+    Command line entry point
+    Example
+        python -m vaccination_data_pipeline --env prod
+        python -m vaccination_data_pipeline --env dev --plan --files 2024_03_31_1711917526756_0.jsonl --countries IND USA
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    environments = list(load_json_file(os.path.join(script_dir, 'pipeline_parameters.json')))
+
+    parser = argparse.ArgumentParser(description="Load vaccination data from S3 Stage into Snowflake")
+    parser.add_argument('--env', choices=environments, default='dev', help="Environment of pipeline_parameters.json")
+    parser.add_argument('--plan', '--dry-run', dest='plan', action='store_true'
+                        , help="Print the statements of the run without connecting to Snowflake")
+    parser.add_argument('--files', nargs='*', default=[], help="(--plan) File names the stage listing returns")
+    parser.add_argument('--countries', nargs='*', default=[], help="(--plan) Countries found in Staging table")
+    args = parser.parse_args(argv)
+
+    if args.plan:
+        session = PlanSession(files = args.files, countries = args.countries)
+        main(session, script = args.env)
+        print(";\n\n".join(statement.strip().rstrip(';') for statement in session.statements) + ";")
+        return
+
+    session = create_session(get_connection_parameters())
+    try:
+        main(session, script = args.env)
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    cli()